@@ -2,17 +2,54 @@ from __future__ import print_function
 import sys, os
 import pygame
 import math
+import io
+import time
+import json
+import threading
+import argparse
+import struct
+import mmap
+import traceback
+import zlib
+import base64
+try:
+    import cPickle as pickle
+except ImportError:
+    import pickle
+from collections import OrderedDict, deque
 from pygame import Surface
 from pygame.sprite import Sprite
 from pygame.sprite import LayeredUpdates
+from xml.etree import ElementTree
 
 # Constants
 SCREEN_WIDTH = 256      # How wide the screen is in "virtual pixels"
 SCREEN_HEIGHT = 240     # How tall the screen is in "virtual pixels"
 SCREEN_ZOOM = 2         # Scale factor of the whole screen
+FULLSCREEN = False      # Whether to take up the whole display
+HARDWARE_SCALING = True # Whether to let SDL scale the screen when it can
 FRAMES_PER_SECOND = 40  # How many frames to draw per second
+TICKS_PER_SECOND = 40   # How many times per second the game logic runs
+MAX_TICKS_PER_FRAME = 5 # Most logic ticks to catch up on before drawing
+MAX_FRAME_SKIP = 4      # Most frames in a row to skip drawing when behind
 CANVAS_ZOOM = 4         # Scale factor of the art canvas
 DEBUG = False           # Whether debug information should show up
+ASSET_CACHE_BUDGET = 32 * 1024 * 1024  # Bytes of decoded images to keep
+ASSET_BUNDLE = os.path.join('data', 'assets.bundle')  # Images packed by tools/bundle.py
+DIRTY_RECTS = False     # Whether to only repaint what changed each frame
+DEBUG_DIRTY = False     # Whether to outline the repainted areas
+PREFETCH_DEPTH = 4      # How many story nodes ahead to load in the background
+PREFETCH_PENDING = 16   # How many background loads can be waiting at once
+MESSAGE_CACHE_SIZE = 64 # How many rendered messages to keep around
+PROFILE_HISTORY = 120   # How many frames of timings the profiler keeps
+ANIMATION_TICKS = 20    # How many logic ticks each frame of an animation shows
+MUSIC_CROSSFADE_MS = 500 # How long one music track takes to fade into the next
+STARTUP_WORKERS = 4     # How many threads load assets behind the title screen
+TILE_CHUNK = 16         # How many tiles wide and tall each cached piece of a map is
+PROFILE_DUMP_KEY = pygame.K_F12  # Key that saves the profiler's timings
+STORY_FILE = os.path.join('data', 'stories.json')   # Where the story is
+STORY_CACHE = os.path.join('data', 'stories.cache') # Compiled story
+STORY_CACHE_VERSION = 3 # Change when the compiled story changes shape
 START_STORY = 'cave'
 #START_STORY = 'future'
 
@@ -26,8 +63,400 @@ CANVAS_HEIGHT = GLYPH_HEIGHT * CANVAS_ZOOM
 CANVAS_X = SCREEN_WIDTH - 8 - CANVAS_WIDTH
 CANVAS_Y = SCREEN_HEIGHT - 8 - CANVAS_HEIGHT
 
+# Dimensions of the stage (in virtual pixels)
+STAGE_SIZE = (224, 80)
 
-# Glyphs in the language
+
+class AssetCache(object):
+    """
+    An AssetCache loads images from disk and shares them between users.
+
+    Images are keyed by their path and conversion mode ('convert',
+    'convert_alpha', or None for the image as decoded).  Surfaces handed
+    out are shared, so callers must not draw on them.  Once the cached
+    images take up more than the byte budget, the least recently used
+    ones are dropped.
+
+    Images found in the bundle, if there is one, are taken from it
+    instead of being decoded from their files.
+
+    The cache may be used from several threads at once.
+    """
+    def __init__(self, budget, bundle=None):
+        """Create a new cache holding at most budget bytes of pixels."""
+        self.budget = budget
+        self.bundle = bundle
+        self.size = 0       # Bytes of pixels currently cached
+        self.hits = 0       # Loads answered from the cache
+        self.misses = 0     # Loads that had to decode the file
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def load(self, path, mode=None):
+        """Return the image at path, converted using mode."""
+        return self._load(path, mode, True)
+
+    def _load(self, path, mode, counted):
+        """
+        Return the image at path, converted using mode, counting the
+        lookup in the hit and miss stats if counted.
+        """
+        key = (path, mode)
+        surf = self._lookup(key, counted)
+        if surf is not None:
+            return surf
+
+        surf = None
+        if mode is not None:
+            # Convert from the decoded image if it is already around.
+            with self._lock:
+                surf = self._entries.get((path, None))
+        if surf is None and self.bundle is not None:
+            surf = self.bundle.surface(path)
+        if surf is None:
+            surf = pygame.image.load(path)
+        if mode == 'convert':
+            surf = surf.convert()
+        elif mode == 'convert_alpha':
+            surf = surf.convert_alpha()
+        self._store(key, surf)
+        return surf
+
+    def load_scaled(self, path, size, mode=None):
+        """Return the image at path, converted using mode and scaled to size."""
+        key = (path, mode, size)
+        surf = self._lookup(key)
+        if surf is not None:
+            return surf
+
+        # Only the scaled lookup counts towards the stats.
+        surf = pygame.transform.scale(self._load(path, mode, False), size)
+        self._store(key, surf)
+        return surf
+
+    def _lookup(self, key, counted=True):
+        """
+        Return the cached surface for key, or None on a miss, counting
+        the lookup in the hit and miss stats if counted.
+        """
+        with self._lock:
+            surf = self._entries.pop(key, None)
+            if surf is None:
+                if counted:
+                    self.misses += 1
+                return None
+
+            # Re-insert the entry to mark it as the most recently used.
+            self._entries[key] = surf
+            if counted:
+                self.hits += 1
+            return surf
+
+    def _store(self, key, surf):
+        """Add a surface to the cache, evicting old ones if needed."""
+        with self._lock:
+            # Another thread may have loaded the same image meanwhile.
+            old_surf = self._entries.pop(key, None)
+            if old_surf is not None:
+                self.size -= surface_bytes(old_surf)
+
+            self._entries[key] = surf
+            self.size += surface_bytes(surf)
+            while self.size > self.budget and len(self._entries) > 1:
+                old_key, old_surf = self._entries.popitem(last=False)
+                self.size -= surface_bytes(old_surf)
+
+    def paths(self):
+        """Return the paths of the images in the cache."""
+        with self._lock:
+            return set(key[0] for key in self._entries)
+
+    def report(self):
+        """Return a short summary of how well the cache is doing."""
+        return 'assets: %d hits, %d misses, %d KiB' \
+               % (self.hits, self.misses, self.size // 1024)
+
+def surface_bytes(surf):
+    """Return how many bytes the pixels of a surface take up."""
+    return surf.get_pitch() * surf.get_height()
+
+class AssetBundle(object):
+    """
+    An AssetBundle is a file of decoded images, so that they can be used
+    without opening and decoding each image file.
+
+    The file starts with a HEADER holding MAGIC, VERSION and the length
+    of the index, which is a JSON list of [path, offset, width, height,
+    pitch, format, mtime, size] for each image.  Paths use '/' between
+    folders, and mtime and size are those of the image file when it was
+    bundled, so that images changed since are loaded from their files
+    instead.  The pixels follow at the next multiple of ALIGN bytes,
+    with offsets counted from there.  They are stored in FORMAT, the
+    usual layout of 32-bit displays, so converting them is cheap.
+    """
+    MAGIC = b'MMWB'
+    VERSION = 2
+    HEADER = struct.Struct('<4sBI')
+    FORMAT = 'BGRA'
+    ALIGN = 16
+
+    @staticmethod
+    def key(path):
+        """Return the name of the image at path in the index."""
+        return path.replace(os.sep, '/')
+
+    @staticmethod
+    def source_info(path):
+        """Return the mtime and size of the image file at path."""
+        info = os.stat(path)
+        return [info.st_mtime, info.st_size]
+
+    def _pixels_start(self, index_size):
+        """Return where the pixels start, given the length of the index."""
+        end = self.HEADER.size + index_size
+        return (end + self.ALIGN - 1) // self.ALIGN * self.ALIGN
+
+class BundleWriter(AssetBundle):
+    """A BundleWriter packs images into a bundle file."""
+    def __init__(self):
+        self._index = []
+        self._pixels = []
+        self._size = 0
+
+    def add(self, path, surf):
+        """Add the image at path, decoded as surf, to the bundle."""
+        if surf.get_colorkey() is not None:
+            # Keep transparent pixels transparent without the colorkey.
+            surf = surf.convert_alpha()
+        pixels = pygame.image.tostring(surf, self.FORMAT)
+        width, height = surf.get_size()
+        self._index.append([self.key(path), self._size, width, height,
+                            len(pixels) // max(height, 1), self.FORMAT]
+                           + self.source_info(path))
+        self._pixels.append(pixels)
+        self._size += len(pixels)
+
+    def save(self, path):
+        """Write the bundle to path."""
+        index = json.dumps(self._index).encode('utf-8')
+        start = self._pixels_start(len(index))
+        with open(path, 'wb') as f:
+            f.write(self.HEADER.pack(self.MAGIC, self.VERSION, len(index)))
+            f.write(index)
+            f.write(b'\0' * (start - self.HEADER.size - len(index)))
+            for pixels in self._pixels:
+                f.write(pixels)
+
+class BundleReader(AssetBundle):
+    """
+    A BundleReader memory-maps a bundle file and makes surfaces that use
+    its pixels where they are.
+    """
+    def __init__(self, path):
+        with open(path, 'rb') as f:
+            # Copy on write, so that drawing on a surface can't change
+            # the file.
+            self._map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_COPY)
+        magic, version, index_size = self.HEADER.unpack_from(self._map, 0)
+        if magic != self.MAGIC or version != self.VERSION:
+            raise ValueError('%s is not a version %d asset bundle'
+                             % (path, self.VERSION))
+        index = self._map[self.HEADER.size:self.HEADER.size + index_size]
+        self._index = dict((entry[0], entry[1:])
+                           for entry in json.loads(index.decode('utf-8')))
+        self._start = self._pixels_start(index_size)
+        try:
+            self._view = memoryview(self._map)
+        except TypeError:
+            # Python 2 can't take a memoryview of an mmap.
+            self._view = None
+
+    def _pixels(self, start, length):
+        """Return the bytes of the file from start, without copying them."""
+        if self._view is None:
+            return buffer(self._map, start, length)
+        return self._view[start:start + length]
+
+    def surface(self, path):
+        """
+        Return the image at path, or None if it isn't in the bundle or
+        the file has changed since it was bundled.
+        """
+        entry = self._index.get(self.key(path))
+        if entry is None:
+            return None
+        offset, width, height, pitch, pixel_format, mtime, size = entry
+        try:
+            if self.source_info(path) != [mtime, size]:
+                return None
+        except OSError:
+            # Nothing to be newer than.
+            pass
+        try:
+            return pygame.image.frombuffer(
+                self._pixels(self._start + offset, pitch * height),
+                (width, height), pixel_format)
+        except (ValueError, TypeError, pygame.error):
+            # This Pygame can't use the pixels as they are.
+            return None
+
+def open_bundle(path):
+    """Return a reader for the bundle at path, or None if there isn't one."""
+    try:
+        return BundleReader(path)
+    except (IOError, OSError, ValueError, TypeError, struct.error):
+        return None
+
+assets = AssetCache(ASSET_CACHE_BUDGET, open_bundle(ASSET_BUNDLE))
+
+class MusicPlayer(object):
+    """
+    A MusicPlayer plays the story's music, fading each track into the
+    next over crossfade_ms milliseconds.
+
+    Tracks are decoded into Sounds on a worker thread, ahead of time for
+    those passed to preload(), and played on two reserved mixer
+    channels, one fading in while the other fades out.  A track asked
+    for before it is decoded starts on the first update() after it is
+    ready.  Asking for the track that is already playing does nothing.
+
+    The main thread never waits for the disk or the decoder.  SDL holds
+    the mixer while it decodes, so even playing or freeing a Sound would
+    wait for a decode to finish: tracks are only handed over between
+    decodes, and the worker frees the tracks that are no longer needed.
+    """
+    CHANNELS = 2    # Mixer channels reserved for music
+
+    def __init__(self, crossfade_ms):
+        """Create a new player; the mixer is only used once it's needed."""
+        self.crossfade_ms = crossfade_ms
+        self.wanted = None      # Path of the track that should be playing
+        self.playing = None     # Path of the track on the current channel
+        self.fading = None      # Path of the track fading out, if any
+        self._sounds = {}       # Decoded tracks by path
+        self._failed = set()    # Paths of tracks that couldn't be decoded
+        self._dropped = []      # Decoded tracks for the worker to free
+        self._decoding = False  # Whether the worker is decoding a track
+        self._pending = deque()
+        self._wake = threading.Condition()
+        self._thread = None
+        self._channel = 0
+
+    def _ready(self):
+        """Return whether there is a mixer to play on, starting up if so."""
+        if pygame.mixer.get_init() is None:
+            return False
+        if self._thread is None:
+            pygame.mixer.set_reserved(self.CHANNELS)
+            self._thread = threading.Thread(target=self._work)
+            self._thread.daemon = True
+            self._thread.start()
+        return True
+
+    def preload(self, path, first=False):
+        """
+        Decode the track at path in the background, if it isn't yet,
+        before any others waiting if first.
+        """
+        if not self._ready():
+            return
+        with self._wake:
+            if path in self._sounds or path in self._failed:
+                return
+            if path in self._pending:
+                if not first:
+                    return
+                self._pending.remove(path)
+            if first:
+                self._pending.appendleft(path)
+            else:
+                self._pending.append(path)
+            self._wake.notify()
+
+    def keep(self, paths):
+        """Forget decoded tracks other than paths and those in use."""
+        paths = set(paths) | set([self.wanted, self.playing, self.fading])
+        with self._wake:
+            for path in list(self._sounds):
+                if path not in paths:
+                    self._dropped.append(self._sounds.pop(path))
+            self._pending = deque(path for path in self._pending
+                                  if path in paths)
+            self._wake.notify()
+
+    def play(self, path):
+        """Fade into the track at path, looping it, unless it's playing."""
+        self.wanted = path
+        if path != self.playing:
+            self.preload(path, True)
+            self.update()
+
+    def _handoff_waiting(self):
+        """Return whether the wanted track is decoded but not yet playing."""
+        return self.wanted != self.playing and self.wanted in self._sounds
+
+    def update(self):
+        """Start the wanted track if it has been decoded since play()."""
+        if self.wanted == self.playing or not self._ready():
+            return
+        with self._wake:
+            if self.wanted in self._failed:
+                print('could not play %s' % self.wanted, file=sys.stderr)
+                self.wanted = self.playing
+                return
+            sound = self._sounds.get(self.wanted)
+            if sound is None or self._decoding:
+                # Try again once the decode is over.
+                return
+
+            # Hand the track over to the other channel.  The worker can't
+            # start decoding while the lock is held.
+            if self.playing is not None:
+                pygame.mixer.Channel(self._channel).fadeout(self.crossfade_ms)
+                self._channel = (self._channel + 1) % self.CHANNELS
+            pygame.mixer.Channel(self._channel).play(
+                sound, loops=-1, fade_ms=self.crossfade_ms)
+            self.fading = self.playing
+            self.playing = self.wanted
+            self._wake.notify()
+
+    def _work(self):
+        """Decode queued tracks and free dropped ones forever."""
+        while True:
+            with self._wake:
+                # Leave the mixer alone while a track waits to be handed
+                # over, so that the handoff doesn't wait for a decode.
+                while not self._dropped and (not self._pending
+                                             or self._handoff_waiting()):
+                    self._wake.wait()
+                dropped = self._dropped
+                self._dropped = []
+                path = None
+                if self._pending and not self._handoff_waiting():
+                    path = self._pending.popleft()
+                    self._decoding = True
+
+            del dropped[:]
+            if path is None:
+                continue
+
+            try:
+                with open(path, 'rb') as f:
+                    sound = pygame.mixer.Sound(file=io.BytesIO(f.read()))
+            except (pygame.error, IOError, OSError):
+                sound = None
+            with self._wake:
+                self._decoding = False
+                if sound is None:
+                    self._failed.add(path)
+                else:
+                    self._sounds[path] = sound
+
+music_player = MusicPlayer(MUSIC_CROSSFADE_MS)
+
+
+# Glyphs in the language; those that come with the game are filled in
+# from GLYPH_IMAGES by load_glyphs()
 glyphs = {
     'fire':    None, 
     'water':   None,
@@ -35,29 +464,116 @@ glyphs = {
     'person':  None,
     'earth':   None,
     'team':    None,
-    'exclaim': pygame.image.load(os.path.join('data', 'exclaim.png')),
-    'question': pygame.image.load(os.path.join('data', 'question.png')),
-    'period': pygame.image.load(os.path.join('data', 'period.png')),
-    'comma': pygame.image.load(os.path.join('data', 'comma.png'))
+    'exclaim': None,
+    'question': None,
+    'period': None,
+    'comma': None
+}
+
+# Images of the glyphs that come with the game
+GLYPH_IMAGES = {
+    'exclaim': os.path.join('data', 'exclaim.png'),
+    'question': os.path.join('data', 'question.png'),
+    'period': os.path.join('data', 'period.png'),
+    'comma': os.path.join('data', 'comma.png')
 }
 
-# Emblems (helpful indications of what is being named)
-emblems = {
-    'earth': pygame.image.load(os.path.join('data', 'earth0.png')),
-    'person': pygame.image.load(os.path.join('data', 'Drawable Images', 'person.png')),
-    'club': pygame.image.load(os.path.join('data', 'Drawable Images', 'weapon.png')),
-    'surrender': pygame.image.load(os.path.join('data', 'bigFlag.png')),
-    'tool': pygame.image.load(os.path.join('data', 'Drawable Images', 'tool.png')),
-    'magic': pygame.image.load(os.path.join('data', 'Drawable Images', 'magic.png')),
-    'art': pygame.image.load(os.path.join('data', 'Drawable Images', 'art.png')),
-    'think': pygame.image.load(os.path.join('data', 'Drawable Images', 'thinking.png')),
-    'team': pygame.image.load(os.path.join('data', 'Drawable Images', 'team.png')),
-    'country': pygame.image.load(os.path.join('data', 'Drawable Images', 'country.png')),
-    'old': pygame.image.load(os.path.join('data', 'Drawable Images', 'antiquated.png')),
-    'give': pygame.image.load(os.path.join('data', 'Drawable Images', 'give.png')),
-    'book': pygame.image.load(os.path.join('data', 'Drawable Images', 'book.png'))
+# Emblems (helpful indications of what is being named), filled in from
+# EMBLEM_IMAGES by load_glyphs()
+emblems = {}
+
+EMBLEM_IMAGES = {
+    'earth': os.path.join('data', 'earth0.png'),
+    'person': os.path.join('data', 'Drawable Images', 'person.png'),
+    'club': os.path.join('data', 'Drawable Images', 'weapon.png'),
+    'surrender': os.path.join('data', 'bigFlag.png'),
+    'tool': os.path.join('data', 'Drawable Images', 'tool.png'),
+    'magic': os.path.join('data', 'Drawable Images', 'magic.png'),
+    'art': os.path.join('data', 'Drawable Images', 'art.png'),
+    'think': os.path.join('data', 'Drawable Images', 'thinking.png'),
+    'team': os.path.join('data', 'Drawable Images', 'team.png'),
+    'country': os.path.join('data', 'Drawable Images', 'country.png'),
+    'old': os.path.join('data', 'Drawable Images', 'antiquated.png'),
+    'give': os.path.join('data', 'Drawable Images', 'give.png'),
+    'book': os.path.join('data', 'Drawable Images', 'book.png')
 }
 
+def load_glyphs():
+    """Load the glyphs and emblems that come with the game."""
+    for name, path in GLYPH_IMAGES.items():
+        if glyphs[name] is None:
+            glyph_atlas.set_glyph(name, assets.load(path))
+    for name, path in EMBLEM_IMAGES.items():
+        emblems[name] = assets.load(path)
+
+def glyph_jobs():
+    """Return the loads load_glyphs() needs, as prefetcher jobs."""
+    return [('image', path, None)
+            for path in sorted(GLYPH_IMAGES.values())
+                        + sorted(EMBLEM_IMAGES.values())]
+
+def sprite_rect(spr):
+    """Return the area a sprite is drawn to, even if its rect is a point."""
+    return pygame.Rect((spr.rect[0], spr.rect[1]), spr.image.get_size())
+
+def merge_rects(rects):
+    """Combine overlapping rects so that no area is repainted twice."""
+    merged = []
+    for rect in rects:
+        rect = pygame.Rect(rect)
+        if rect.width == 0 or rect.height == 0:
+            continue
+        i = rect.collidelist(merged)
+        while i != -1:
+            rect.union_ip(merged.pop(i))
+            i = rect.collidelist(merged)
+        merged.append(rect)
+    return merged
+
+class DirtyTracker(object):
+    """
+    A DirtyTracker works out which parts of a group's drawing changed.
+
+    It remembers where each sprite was drawn and with which image, so a
+    sprite that moved, switched images, appeared or disappeared makes
+    its old and new areas dirty.  Sprites that draw onto their own image
+    list the parts they changed in a dirty_rects attribute, which the
+    tracker empties once it has seen them.
+    """
+    def __init__(self):
+        """Create a new tracker that has not seen anything drawn yet."""
+        self._drawn = {}
+
+    def collect(self, group):
+        """Return the areas of the group that changed since last time."""
+        rects = []
+        drawn = {}
+        for spr in group.sprites():
+            area = sprite_rect(spr)
+            drawn[spr] = (spr.image, area)
+
+            prev = self._drawn.pop(spr, None)
+            if prev is None or prev[0] is not spr.image or prev[1] != area:
+                if prev is not None:
+                    rects.append(prev[1])
+                rects.append(area)
+            else:
+                for rect in getattr(spr, 'dirty_rects', ()):
+                    rects.append(rect.move(area.topleft))
+            spr.dirty_rects = []
+
+        # Whatever is left was removed from the group.
+        for image, area in self._drawn.values():
+            rects.append(area)
+
+        self._drawn = drawn
+        return merge_rects(rects)
+
+    def reset(self):
+        """Forget what was drawn, making everything dirty next time."""
+        self._drawn = {}
+
+
 # Object types
 class Frame(Sprite):
     """
@@ -68,27 +584,22 @@ class Frame(Sprite):
         Sprite.__init__(self)
         self.set_image('BronzeAgeFrame.png')
     def set_image(self, frame_name):
-        self.image = pygame.image.load(os.path.join('data', frame_name)).convert_alpha()
+        self.image = assets.load(os.path.join('data', frame_name), 'convert_alpha')
         self.rect = self.image.get_rect()
 
 
-def color_code_to_color(code):
-    if code == 0:
-        # Transparent pixel
-        color = (255, 0, 255)
-    elif code == 1:
-        # Black pixel
-        color = (0, 0, 0)
-    elif code == 2:
-        # Red pixel
-        color = (255, 0, 0)
-    elif code == 3:
-        # Green pixel
-        color = (0, 255, 0)
-    elif code == 4:
-        # Brown pixel
-        color = (125, 100, 0)
-    return color
+# Colors of the pixel codes, which double as the palette of glyphs
+COLOR_CODES = [
+    (255, 0, 255),  # Transparent pixel
+    (0, 0, 0),      # Black pixel
+    (255, 0, 0),    # Red pixel
+    (0, 255, 0),    # Green pixel
+    (125, 100, 0)   # Brown pixel
+]
+
+# Colors of the pixel codes as shown on the art canvas, where transparent
+# pixels are white.
+CANVAS_PALETTE = [(255, 255, 255)] + COLOR_CODES[1:]
 
 class OkayButton(Sprite):
     """
@@ -96,7 +607,7 @@ class OkayButton(Sprite):
     """
     def __init__(self, x, y, game):
         Sprite.__init__(self)
-        self.image = pygame.image.load(os.path.join('data', 'okay.png'))
+        self.image = assets.load(os.path.join('data', 'okay.png'))
         self.rect = (x, y)
         self.game = game
 
@@ -108,9 +619,9 @@ class OkayButton(Sprite):
                and mouse_x < self.rect[0] + self.image.get_width() \
                and mouse_y >= self.rect[1] \
                and mouse_y < self.rect[1] + self.image.get_height():
-                glyphs[stories[game.story][game.index].glyph_name] = \
-                  game.canvas.to_surface()
-                game._jump(game.story, game.index + 1)
+                glyph_atlas.set_glyph(game.node.st.glyph_name,
+                                      game.canvas.to_surface())
+                game._advance()
 
 class EqualsSign(Sprite):
     def __init__(self, x, y):
@@ -126,6 +637,8 @@ class Canvas(Sprite):
     """
     A Canvas is what the player draws new glyphs onto.
     """
+    _grid = None    # Grid lines drawn over every canvas, built once
+
     def __init__(self):
         """Create a new art canvas."""
         Sprite.__init__(self)
@@ -135,16 +648,21 @@ class Canvas(Sprite):
                               GLYPH_HEIGHT * CANVAS_ZOOM))
         self.rect = (CANVAS_X, CANVAS_Y)
 
-        # Helper variables for handling mouse lag
-        self._was_drawing = False
-        self._prev_sel = (0, 0)
+        # Cell the current stroke last reached, or None between strokes
+        self._stroke_end = None
 
-        # Storage for the canvas' pixels
-        self.pixels = []
-        for y in range(0, CANVAS_HEIGHT):
-            self.pixels.append([])
-            for x in range(0, CANVAS_WIDTH):
-                self.pixels[y].append(0)
+        # Storage for the canvas' pixels, one color code per byte, row
+        # by row.  _pixel_view is an 8-bit surface sharing that memory.
+        self.pixels = bytearray(GLYPH_WIDTH * GLYPH_HEIGHT)
+        self._pixel_view = pygame.image.frombuffer(self.pixels,
+                                                   (GLYPH_WIDTH, GLYPH_HEIGHT),
+                                                   'P')
+        self._pixel_view.set_palette(CANVAS_PALETTE)
+        self._zoomed = Surface(self.image.get_size(), 0, self._pixel_view)
+        self._zoomed.set_palette(CANVAS_PALETTE)
+
+        # Parts of the image changed since it was last drawn
+        self.dirty_rects = []
 
         # Initialize the image
         self._redraw_image()
@@ -156,83 +674,239 @@ class Canvas(Sprite):
                and mouse_y >= self.rect[1] \
                and mouse_y < self.rect[1] + CANVAS_HEIGHT
 
+    @classmethod
+    def _grid_overlay(cls):
+        """Return the grid lines shared by all canvases."""
+        if cls._grid is None:
+            grid = Surface((CANVAS_WIDTH, CANVAS_HEIGHT))
+            grid.set_colorkey((255, 0, 255))
+            grid.fill((255, 0, 255))
+            for y in range(GLYPH_HEIGHT):
+                pygame.draw.line(grid, (100, 100, 200), (0, y * CANVAS_ZOOM), (GLYPH_WIDTH * CANVAS_ZOOM, y * CANVAS_ZOOM))
+            for x in range(GLYPH_WIDTH):
+                pygame.draw.line(grid, (100, 100, 200), (x * CANVAS_ZOOM, 0), (x * CANVAS_ZOOM, GLYPH_HEIGHT * CANVAS_ZOOM))
+            cls._grid = grid
+        return cls._grid
+
     def _redraw_image(self):
         """Redraw the image of the canvas."""
-        self.image.fill((255, 255, 255),
-                        (0, 0,
-                         CANVAS_WIDTH * CANVAS_ZOOM,
-                         CANVAS_HEIGHT * CANVAS_ZOOM))
-
-        for y in range(len(self.pixels)):
-            for x in range(len(self.pixels[0])):
-                pixel = self.pixels[y][x]
-                color = color_code_to_color(pixel)
-                if color == (255, 0, 255):
-                    color = (255, 255, 255)
-                self.image.fill(color,
-                                (x * CANVAS_ZOOM,
-                                 y * CANVAS_ZOOM,
-                                 CANVAS_ZOOM, CANVAS_ZOOM))
-
-        # Draw the grid
-        for y in range(len(self.pixels)):
-            pygame.draw.line(self.image, (100, 100, 200), (0, y * CANVAS_ZOOM), (GLYPH_WIDTH * CANVAS_ZOOM, y * CANVAS_ZOOM))
-        for x in range(len(self.pixels)):
-            pygame.draw.line(self.image, (100, 100, 200), (x * CANVAS_ZOOM, 0), (x * CANVAS_ZOOM, GLYPH_HEIGHT * CANVAS_ZOOM))
+        # Zoom all of the pixels at once, then copy them to the image.
+        pygame.transform.scale(self._pixel_view, self._zoomed.get_size(),
+                               self._zoomed)
+        self.image.blit(self._zoomed, (0, 0))
+        self.image.blit(self._grid_overlay(), (0, 0))
+
+        self.dirty_rects = [self.image.get_rect()]
+
+    def _paint(self, cells, code):
+        """
+        Set the pixels at cells, then redraw the cells that changed in
+        one go.
+        """
+        changed = []
+        for x, y in cells:
+            i = y * GLYPH_WIDTH + x
+            if self.pixels[i] != code:
+                self.pixels[i] = code
+                changed.append((x, y))
+
+        grid = self._grid_overlay()
+        for x, y in changed:
+            cell = pygame.Rect(x * CANVAS_ZOOM, y * CANVAS_ZOOM,
+                               CANVAS_ZOOM, CANVAS_ZOOM)
+            self.image.fill(CANVAS_PALETTE[code], cell)
+            self.image.blit(grid, cell, cell)
+            self.dirty_rects.append(cell)
 
     def to_surface(self):
-        surf = pygame.Surface((GLYPH_WIDTH, GLYPH_HEIGHT))
-        surf.set_colorkey((255, 0, 255))
-        surf.fill((255, 0, 255))
-        for y in range(0, GLYPH_HEIGHT):
-            for x in range(0, GLYPH_WIDTH):
-                pygame.draw.rect(surf, color_code_to_color(self.pixels[y][x]), (x, y, 1, 1))
+        """Return the drawing as an 8-bit glyph using the color codes."""
+        surf = pygame.image.frombuffer(bytes(self.pixels),
+                                       (GLYPH_WIDTH, GLYPH_HEIGHT), 'P')
+        surf.set_palette(COLOR_CODES)
+        surf.set_colorkey(0, pygame.RLEACCEL)
         return surf
 
-    def update(self):
-        """Update the state of the canvas."""
-        # If the user is painting, place a pixel.
-        if self.is_selecting():
-            self.pen_x = int(math.floor((mouse_x - self.rect[0]) / CANVAS_ZOOM))
-            self.pen_y = int(math.floor((mouse_y - self.rect[1]) / CANVAS_ZOOM))
-
-            if mouse_held:
-                if self._was_drawing:
-                    # Draw a line from the previous position
-                    # to the current position
-                    """
-                    distance = math.sqrt(
-                                 (self._prev_sel[0]
-                                   - self.pen_x) ** 2
-                                 + (self._prev_sel[1]
-                                    - self.pen_y) ** 2)
-                    angle = 
-                    """
-                else:
-                    self._prev_sel = (self.pen_x, self.pen_y)
-                    self._was_drawing = True
+    def _cell_at(self, x, y):
+        """Return the cell of the canvas at (x, y), or None if off it."""
+        if self.rect[0] <= x < self.rect[0] + CANVAS_WIDTH \
+           and self.rect[1] <= y < self.rect[1] + CANVAS_HEIGHT:
+            return ((x - self.rect[0]) // CANVAS_ZOOM,
+                    (y - self.rect[1]) // CANVAS_ZOOM)
+        return None
 
-                self.pixels[self.pen_y][self.pen_x] = 1
-                self._redraw_image()
-            else:
-                self._was_drawing = False
-        else:
-            self._was_drawing = False
+    def update(self):
+        """Paint the strokes made since the last update."""
+        # Follow every position the mouse went through, joining those
+        # with the button held by lines, so fast strokes leave no gaps.
+        cells = []
+        for x, y, held in mouse_path:
+            cell = self._cell_at(x, y)
+            if cell is not None:
+                self.pen_x, self.pen_y = cell
+            if not held or cell is None:
+                # Lifting the button or leaving the canvas ends the stroke.
+                self._stroke_end = None
+            elif self._stroke_end is None:
+                cells.append(cell)
+                self._stroke_end = cell
+            elif cell != self._stroke_end:
+                cells.extend(line_cells(self._stroke_end, cell)[1:])
+                self._stroke_end = cell
+        if cells:
+            self._paint(cells, 1)
 
     def clear(self):
-        for y in range(0, CANVAS_HEIGHT):
-            for x in range(0, CANVAS_WIDTH):
-                self.pixels[y][x] = 0
+        self.pixels[:] = bytearray(len(self.pixels))
+        self._stroke_end = None
         self._redraw_image()
 
 
+def line_cells(start, end):
+    """Return the cells on a line from start to end, both included."""
+    x, y = start
+    dx = abs(end[0] - x)
+    dy = -abs(end[1] - y)
+    step_x = 1 if end[0] > x else -1
+    step_y = 1 if end[1] > y else -1
+    error = dx + dy
+    cells = [(x, y)]
+    while (x, y) != end:
+        # Bresenham's algorithm: step along whichever axes keep the line
+        # closest to the ideal one.
+        doubled = 2 * error
+        if doubled >= dy:
+            error += dy
+            x += step_x
+        if doubled <= dx:
+            error += dx
+            y += step_y
+        cells.append((x, y))
+    return cells
+
+timer = getattr(time, 'perf_counter', time.time)
+
+class FrameProfiler(object):
+    """
+    A FrameProfiler times each phase of the main loop.
+
+    The timings of the last few frames are kept in a ring buffer, oldest
+    first from recent().
+    """
+    PHASES = ('events', 'update', 'draw', 'scale', 'flip')
+    COLORS = [(255, 255, 0), (0, 255, 0), (0, 128, 255),
+              (255, 128, 0), (255, 0, 0)]
+
+    def __init__(self, size):
+        """Create a new profiler remembering size frames."""
+        self.size = size
+        self.count = 0      # How many frames have been timed in total
+        self._samples = [None] * size
+        self._current = None
+        self._mark = None
+
+    def start(self):
+        """Start timing a new frame."""
+        self._current = [0.0] * len(self.PHASES)
+        self._mark = timer()
+
+    def lap(self, phase):
+        """Add the time since the last lap to the given phase."""
+        if self._mark is None:
+            return
+        now = timer()
+        self._current[self.PHASES.index(phase)] += now - self._mark
+        self._mark = now
+
+    def end_frame(self):
+        """Store the timings of the frame being timed."""
+        if self._mark is None:
+            return
+        self._samples[self.count % self.size] = tuple(self._current)
+        self.count += 1
+        self._mark = None
+
+    def recent(self):
+        """Return the stored timings, oldest first."""
+        if self.count < self.size:
+            return self._samples[:self.count]
+        i = self.count % self.size
+        return self._samples[i:] + self._samples[:i]
+
+    def dump(self, basename):
+        """Save the stored timings (in milliseconds) as CSV and JSON."""
+        first = self.count - len(self.recent())
+        rows = [[first + i] + [round(t * 1000, 3) for t in sample]
+                for i, sample in enumerate(self.recent())]
+
+        with open(basename + '.csv', 'w') as f:
+            f.write(','.join(('frame',) + self.PHASES) + '\n')
+            for row in rows:
+                f.write(','.join(str(value) for value in row) + '\n')
+
+        with open(basename + '.json', 'w') as f:
+            json.dump({'phases': self.PHASES, 'unit': 'ms', 'frames': rows},
+                      f)
+
+profiler = FrameProfiler(PROFILE_HISTORY)
+
+class SimulationClock(object):
+    """
+    A SimulationClock runs the game logic at a fixed rate, measured in
+    real time rather than in frames drawn.
+
+    Each frame, advance() says how many logic ticks are due.  When a
+    frame runs long, the following frames run several ticks to catch up,
+    so everything counted in ticks keeps to real time.
+    """
+    def __init__(self, rate, max_ticks, max_lag=1000):
+        """
+        Create a clock ticking rate times per second, running at most
+        max_ticks per frame and forgetting stalls longer than max_lag
+        milliseconds.
+        """
+        self.step = 1000.0 / rate
+        self.max_ticks = max_ticks
+        self.max_lag = max_lag
+        self.ticks = 0      # How many logic ticks have run in total
+        self._last = None
+        self._lag = 0.0
+
+    def reset(self):
+        """Start counting from now, with one tick due right away."""
+        self._last = pygame.time.get_ticks()
+        self._lag = self.step
+
+    def advance(self):
+        """Return how many logic ticks are due since the last call."""
+        now = pygame.time.get_ticks()
+        if self._last is None:
+            self.reset()
+        else:
+            # Don't try to make up for long stalls, like a dragged window.
+            self._lag = min(self._lag + now - self._last, self.max_lag)
+            self._last = now
+
+        ticks = min(int(self._lag // self.step), self.max_ticks)
+        self._lag -= ticks * self.step
+        self.ticks += ticks
+        return ticks
+
+    def behind(self):
+        """Return whether more ticks are due than were run."""
+        return self._lag >= self.step
+
 class DebugReadout(Sprite):
     """
     A DebugReadout shows useful debugging information on-screen.
 
-    It currently shows the cursor position and the coordinates of the
-    selected pixel on the art canvas.
+    It currently shows the cursor position, the coordinates of the
+    selected pixel on the art canvas, how the asset cache is doing, and
+    how long each phase of the main loop takes, both as averages and as
+    a rolling graph.  Pressing PROFILE_DUMP_KEY saves the timings.
     """
+    GRAPH_HEIGHT = 50   # Height of the timing graph (in virtual pixels)
+    GRAPH_SCALE = 2     # Virtual pixels per millisecond in the graph
+
     def __init__(self, canvas):
         """Create a new debug readout."""
         Sprite.__init__(self)
@@ -241,80 +915,157 @@ class DebugReadout(Sprite):
         self.rect = (0, 0)
         self.canvas = canvas
 
+        # Rendered lines of text, so unchanged lines aren't rendered again
+        self._text_cache = {}
+        self._averages = []
+
+    def _render_line(self, line):
+        """Return an image of a line of text, rendering it if needed."""
+        line_img = self._text_cache.get(line)
+        if line_img is None:
+            if len(self._text_cache) > 64:
+                self._text_cache.clear()
+            line_img = debug_font.render(line, False, (255, 255, 255))
+            self._text_cache[line] = line_img
+        return line_img
+
     def update(self):
         """Update the readout using current information."""
         self.image.fill((255, 0, 255))
 
+        if PROFILE_DUMP_KEY in keys_just_pressed:
+            profiler.dump(time.strftime('profile-%Y%m%d-%H%M%S'))
+
+        samples = profiler.recent()
+
+        # Only work out the averages once a second so they stay readable
+        # and their text doesn't have to be rendered every frame.
+        if samples and profiler.count % FRAMES_PER_SECOND == 1:
+            self._averages = []
+            for i, phase in enumerate(FrameProfiler.PHASES):
+                total = sum(sample[i] for sample in samples)
+                self._averages.append('%s: %.2f ms'
+                                      % (phase, total * 1000 / len(samples)))
+
         debug_lines = [
-            'cursor: (%d, %d)' % (mouse_x, mouse_y)
+            'cursor: (%d, %d)' % (mouse_x, mouse_y),
+            assets.report()
         ]
 
         if self.canvas.is_selecting():
             debug_lines += ['selection: (%d, %d)'
                             % (self.canvas.pen_x, self.canvas.pen_y)]
 
+        debug_lines += self._averages
+
         line_num = 0
         for line in debug_lines:
-            line_img = debug_font.render(line, False, (255, 255, 255))
-            self.image.blit(line_img, (0, line_num * 16))
+            self.image.blit(self._render_line(line), (0, line_num * 16))
             line_num += 1
 
+        self._draw_graph(samples)
+
+        self.dirty_rects = [self.image.get_rect()]
+
+    def _draw_graph(self, samples):
+        """Draw each frame's phase timings as a stacked bar."""
+        bottom = SCREEN_HEIGHT - 1
+        top = bottom - self.GRAPH_HEIGHT
+        for x, sample in enumerate(samples):
+            y = bottom
+            for color, duration in zip(FrameProfiler.COLORS, sample):
+                height = int(duration * 1000 * self.GRAPH_SCALE)
+                if height > 0:
+                    pygame.draw.line(self.image, color, (x, y),
+                                     (x, max(y - height, top)))
+                    y -= height
+                if y <= top:
+                    break
+
+        # Mark the time each frame is allowed to take.
+        budget = bottom - int(1000.0 / FRAMES_PER_SECOND * self.GRAPH_SCALE)
+        if budget >= top:
+            pygame.draw.line(self.image, (255, 255, 255),
+                             (0, budget), (profiler.size, budget))
+
 class Dummy(Sprite):
     def __init__(self):
         Sprite.__init__(self)
         self.rect = (0, 0)
-        self.image = pygame.image.load(os.path.join("data", "dummy.png"))
+        self.image = assets.load(os.path.join("data", "dummy.png"))
+
+class AnimationClock(object):
+    """
+    An AnimationClock counts logic ticks for every animated sprite.
+
+    Sprites work out which of their frames to show from the clock when
+    they are drawn, so they don't need updating each tick.
+    """
+    def __init__(self, ticks_per_frame):
+        """Create a new clock showing each frame for ticks_per_frame ticks."""
+        self.ticks_per_frame = ticks_per_frame
+        self.ticks = 0
+
+    def tick(self):
+        """Move every animation on by one logic tick."""
+        self.ticks += 1
+
+    def frame(self, phase, count):
+        """Return which of count frames to show, starting at tick phase."""
+        return (self.ticks - phase) // self.ticks_per_frame % count
+
+anim_clock = AnimationClock(ANIMATION_TICKS)
 
 class AnimatedSprite(Sprite):
+    clock_driven = True     # Whether update() can be skipped
+
     def __init__(self):
         Sprite.__init__(self)
+        self.phase = anim_clock.ticks   # Tick the animation started on
+
+    @property
+    def image(self):
+        return self.frames[anim_clock.frame(self.phase, len(self.frames))]
 
     def setup(self, x, y, images):
         frames = []
         for img in images:
-            frames.append(pygame.image.load(os.path.join('data', img)).convert_alpha())
-        self.image = frames[0]
-        self.rect = self.image.get_rect().move((x, y))
-        self.timer = 0
+            frames.append(assets.load(os.path.join('data', img), 'convert_alpha'))
         self.frames = frames
-        self.frame = 0
+        self.rect = self.image.get_rect().move((x, y))
 
     def clone(self, x, y):
         spr = AnimatedSprite()
         spr.frames = self.frames
-        spr.timer = 0
-        spr.image = spr.frames[0]
         spr.rect = spr.image.get_rect().move((x, y))
-        spr.frame = 0
         return spr
 
-    def update(self):
-        if hasattr(self, 'extra_update'):
-            self.extra_update()
-
-        self.timer += 1
-
-        if self.timer == 20:
-            self.timer = 0
-            self.frame = (self.frame + 1) % len(self.frames)
-
-        self.image = self.frames[self.frame]
-
-class AnimatedSheet(Sprite):
-    '''Animated sprite using a spritesheet.'''
-    def __init__(self):
-        Sprite.__init__(self)
+class SheetFrames(object):
+    """
+    SheetFrames are the frames of an animation cut out of a spritesheet.
 
-    def setup(self, x, y, sheet_name, ncols, nrows, clip_region):
-        sheet = pygame.image.load(os.path.join('data', sheet_name)).convert_alpha()
+    The frames are subsurfaces of the sheet, so they share its pixels
+    instead of copying them.  The flipped frames are only made the first
+    time they are asked for.  offset is where the frames go inside a
+    full frame of the sheet, if their edges were trimmed away, and
+    flipped_offset is the same for the flipped frames.
+    """
+    def __init__(self, frames, offset=(0, 0), flipped_offset=(0, 0)):
+        self.frames = frames
+        self.offset = offset
+        self.flipped_offset = flipped_offset
+        self._flipped = None
 
+    @classmethod
+    def grid(cls, sheet, ncols, nrows, clip_region):
+        """Cut ncols by nrows frames, clipped to clip_region, from sheet."""
         # The region inside a frame to use as the sprite
         clip_region = pygame.Rect(clip_region)
 
         # The size of a single frame
-        frame_width = sheet.get_width() / ncols
-        frame_height = sheet.get_height() / nrows
-        
+        frame_width = sheet.get_width() // ncols
+        frame_height = sheet.get_height() // nrows
+
         frames = []
         for col in range(ncols):
             for row in range(nrows):
@@ -324,91 +1075,594 @@ class AnimatedSheet(Sprite):
                                            frame_height)
                 frame_region = frame_region.clip(clip_region.move(col*frame_width,
                                                                   row*frame_height))
-                
-                surf = pygame.Surface((frame_region.width, frame_region.height), pygame.SRCALPHA)
-                surf.blit(sheet, (0, 0), frame_region)
+                frames.append(sheet.subsurface(frame_region))
+        return cls(frames)
+
+    @classmethod
+    def packed(cls, sheet, info):
+        """
+        Cut the frames listed in info, as written by tools/unpiskel.py
+        --sheet, from sheet.
+        """
+        frames = [sheet.subsurface(frame['rect']) for frame in info['frames']]
+        x, y, width, height = info['clip']
+        return cls(frames, (x, y), (info['size'][0] - x - width, y))
+
+    def flipped(self):
+        """Return the frames flipped horizontally."""
+        if self._flipped is None:
+            self._flipped = [pygame.transform.flip(f, True, False)
+                             for f in self.frames]
+        return self._flipped
 
-                frames.append(surf)
+class AnimatedSheet(Sprite):
+    '''Animated sprite using a spritesheet.'''
+    clock_driven = True     # Whether update() can be skipped
+    _sheets = {}    # SheetFrames by sheet, grid and clip region or metadata
 
-        self.image = frames[0]
-        self.rect = self.image.get_rect().move((x, y))
-        self.frames = frames
-        self.flipped_frames = [pygame.transform.flip(f, True, False) for f in self.frames]
-        self.timer = 0
-        self.frame = 0
+    def __init__(self):
+        Sprite.__init__(self)
+        self.phase = anim_clock.ticks   # Tick the animation started on
 
-    def clone(self, x, y, flip=False):
-        spr = AnimatedSheet()
-        spr.image = self.frames[0]
-        spr.rect = self.image.get_rect().move((x, y))
+    @property
+    def image(self):
+        return self.frames[anim_clock.frame(self.phase, len(self.frames))]
+
+    def setup(self, x, y, sheet_name, ncols, nrows, clip_region):
+        key = (sheet_name, ncols, nrows, tuple(clip_region))
+        sheet = AnimatedSheet._sheets.get(key)
+        if sheet is None:
+            sheet = SheetFrames.grid(assets.load(os.path.join('data', sheet_name),
+                                                 'convert_alpha'),
+                                     ncols, nrows, clip_region)
+            AnimatedSheet._sheets[key] = sheet
+        self._place(sheet, x, y)
+
+    def load(self, x, y, info_name):
+        """Set up the sprite from a sheet made by tools/unpiskel.py --sheet."""
+        sheet = AnimatedSheet._sheets.get(info_name)
+        if sheet is None:
+            with open(os.path.join('data', info_name)) as f:
+                info = json.load(f)
+            sheet = SheetFrames.packed(assets.load(os.path.join('data', info['image']),
+                                                   'convert_alpha'),
+                                       info)
+            AnimatedSheet._sheets[info_name] = sheet
+        self._place(sheet, x, y)
+
+    def _place(self, sheet, x, y, flip=False):
+        """Show the frames of sheet with the full frame's corner at (x, y)."""
+        self.sheet = sheet
         if flip:
-            spr.frames = self.flipped_frames
+            self.frames = sheet.flipped()
+            offset = sheet.flipped_offset
         else:
-            spr.frames = self.frames
-        spr.timer = 0
-        spr.frame = 0
-        return spr
-
-    def update(self):
-        self.timer += 1
-
-        if self.timer == 20:
-            self.timer = 0
-            self.frame = (self.frame + 1) % len(self.frames)
+            self.frames = sheet.frames
+            offset = sheet.offset
+        self.rect = self.image.get_rect().move((x + offset[0],
+                                                y + offset[1]))
 
-        self.image = self.frames[self.frame]
+    def clone(self, x, y, flip=False):
+        spr = AnimatedSheet()
+        spr._place(self.sheet, x, y, flip)
+        return spr
 
 class AnimatedDummy(AnimatedSprite):
     def __init__(self, frames):
         AnimatedSprite.__init__(self, images)
         self.rect = (40, 40)
 
+# Flags kept in the top bits of a tile in a Tiled map
+TILE_FLIP_X = 0x80000000
+TILE_FLIP_Y = 0x40000000
+TILE_FLIP_DIAGONAL = 0x20000000
+TILE_FLAGS = TILE_FLIP_X | TILE_FLIP_Y | TILE_FLIP_DIAGONAL
+
+def is_tile_map(name):
+    """Return whether a stage background names a Tiled map."""
+    return name.lower().endswith('.tmx')
+
+class Tileset(object):
+    """
+    A Tileset is the image the tiles of Tiled maps are cut from, read
+    from a .tsx file.
+
+    Each tileset is read once and shared by every map using it.  Its
+    image is only decoded the first time a tile is drawn, and the tiles
+    cut from it are kept, one for each way of flipping them.
+    """
+    _tilesets = {}  # Tilesets by path
+
+    def __init__(self, path):
+        """Read the tileset file at path."""
+        root = ElementTree.parse(path).getroot()
+        self.tile_size = (int(root.get('tilewidth')),
+                          int(root.get('tileheight')))
+        self.columns = int(root.get('columns'))
+        self.image_path = os.path.normpath(
+            os.path.join(os.path.dirname(path),
+                         root.find('image').get('source')))
+
+        # Frames of animated tiles, as (tile, logic ticks) pairs
+        self.animations = {}
+        for tile in root.findall('tile'):
+            animation = tile.find('animation')
+            if animation is not None:
+                self.animations[int(tile.get('id'))] = [
+                    (int(frame.get('tileid')),
+                     max(1, int(round(int(frame.get('duration'))
+                                      * TICKS_PER_SECOND / 1000.0))))
+                    for frame in animation.findall('frame')]
+
+        self._image = None
+        self._tiles = {}
+
+    @classmethod
+    def load(cls, path):
+        """Return the tileset read from path, reading it if needed."""
+        path = os.path.normpath(path)
+        tileset = cls._tilesets.get(path)
+        if tileset is None:
+            # Another thread may be reading the same file; keep one.
+            tileset = cls._tilesets.setdefault(path, cls(path))
+        return tileset
+
+    def image(self):
+        """Return the tileset's image, decoding it if needed."""
+        if self._image is None:
+            self._image = assets.load(self.image_path, 'convert_alpha')
+        return self._image
+
+    def tile(self, tile):
+        """Return the image of a tile, which may carry flip flags."""
+        image = self._tiles.get(tile)
+        if image is None:
+            index = tile & ~TILE_FLAGS
+            width, height = self.tile_size
+            image = self.image().subsurface(
+                ((index % self.columns) * width,
+                 (index // self.columns) * height, width, height))
+            if tile & TILE_FLIP_DIAGONAL:
+                image = pygame.transform.flip(
+                    pygame.transform.rotate(image, 90), False, True)
+            if tile & (TILE_FLIP_X | TILE_FLIP_Y):
+                image = pygame.transform.flip(image, bool(tile & TILE_FLIP_X),
+                                              bool(tile & TILE_FLIP_Y))
+            self._tiles[tile] = image
+        return image
+
+    def frame(self, tile, ticks):
+        """Return which tile an animated tile shows at a tick of anim_clock."""
+        frames = self.animations[tile & ~TILE_FLAGS]
+        ticks %= sum(duration for frame, duration in frames)
+        for frame, duration in frames:
+            if ticks < duration:
+                break
+            ticks -= duration
+        return frame | (tile & TILE_FLAGS)
+
+class TileLayer(object):
+    """
+    A TileLayer is one layer of tiles in a Tiled map.
+
+    The layer is drawn from pieces TILE_CHUNK tiles square, which are
+    rendered the first time they show and kept, so scrolling the layer
+    only copies pieces around.  Animated tiles are left out of the
+    pieces and drawn over them with their current frame.  A layer with a
+    parallax factor below 1 scrolls more slowly than the map, and one
+    above 1 more quickly.
+    """
+    def __init__(self, tile_map, node):
+        """Read a layer of tile_map from its <layer> element."""
+        self.map = tile_map
+        self.name = node.get('name')
+        self.width = int(node.get('width'))
+        self.height = int(node.get('height'))
+        self.offset = (int(round(float(node.get('offsetx', 0)))),
+                       int(round(float(node.get('offsety', 0)))))
+        self.parallax = (float(node.get('parallaxx', 1)),
+                         float(node.get('parallaxy', 1)))
+        self.opacity = int(round(float(node.get('opacity', 1)) * 255))
+        self.visible = node.get('visible', '1') != '0'
+        self.tiles = self._read_tiles(node.find('data'))
+        self._chunks = {}   # Rendered pieces by chunk position
+        self._animated = {} # Animated tiles in each piece
+        self._faded = {}    # Frames of animated tiles at the layer's opacity
+
+    def _read_tiles(self, data):
+        """Return the global tile ids of the layer, row by row."""
+        encoding = data.get('encoding')
+        if encoding == 'csv':
+            return [int(tile) for tile in data.text.split(',')]
+        elif encoding == 'base64':
+            raw = base64.b64decode(data.text.strip())
+            compression = data.get('compression')
+            if compression == 'zlib':
+                raw = zlib.decompress(raw)
+            elif compression == 'gzip':
+                raw = zlib.decompress(raw, 16 + zlib.MAX_WBITS)
+            elif compression is not None:
+                raise ValueError('layer %r of %s uses unknown compression %r'
+                                 % (self.name, self.map.path, compression))
+            return list(struct.unpack('<%dI' % (len(raw) // 4), raw))
+        elif encoding is None:
+            return [int(tile.get('gid', 0)) for tile in data.findall('tile')]
+        raise ValueError('layer %r of %s uses unknown encoding %r'
+                         % (self.name, self.map.path, encoding))
+
+    def draw(self, surf, scroll):
+        """Draw the layer onto surf, scrolled to scroll."""
+        tile_width, tile_height = self.map.tile_size
+        chunk_width = TILE_CHUNK * tile_width
+        chunk_height = TILE_CHUNK * tile_height
+        x = self.offset[0] - int(scroll[0] * self.parallax[0])
+        y = self.offset[1] - int(scroll[1] * self.parallax[1])
+
+        # Only the pieces overlapping the surface's clip area are drawn.
+        area = surf.get_clip().move(-x, -y)
+        for cy in range(max(area.top // chunk_height, 0),
+                        min((area.bottom - 1) // chunk_height + 1,
+                            (self.height - 1) // TILE_CHUNK + 1)):
+            for cx in range(max(area.left // chunk_width, 0),
+                            min((area.right - 1) // chunk_width + 1,
+                                (self.width - 1) // TILE_CHUNK + 1)):
+                chunk = self._chunks.get((cx, cy))
+                if chunk is None:
+                    chunk = self._render(cx, cy)
+                pos = (x + cx * chunk_width, y + cy * chunk_height)
+                surf.blit(chunk, pos)
+                for tx, ty, tile in self._animated[(cx, cy)]:
+                    image = self.map.frame(tile, anim_clock.ticks)
+                    if image is not None:
+                        if self.opacity < 255:
+                            image = self._fade(image)
+                        surf.blit(image, (pos[0] + tx, pos[1] + ty))
+
+    def _fade(self, image):
+        """Return a tile image at the layer's opacity, like the pieces."""
+        faded = self._faded.get(image)
+        if faded is None:
+            faded = image.convert_alpha()
+            faded.fill((255, 255, 255, self.opacity),
+                       special_flags=pygame.BLEND_RGBA_MULT)
+            self._faded[image] = faded
+        return faded
+
+    def _render(self, cx, cy):
+        """Render and keep the piece of the layer at chunk (cx, cy)."""
+        tile_width, tile_height = self.map.tile_size
+        chunk = Surface((TILE_CHUNK * tile_width, TILE_CHUNK * tile_height),
+                        pygame.SRCALPHA)
+        chunk.fill((0, 0, 0, 0))
+        animated = []
+        for row in range(cy * TILE_CHUNK,
+                         min((cy + 1) * TILE_CHUNK, self.height)):
+            for col in range(cx * TILE_CHUNK,
+                             min((cx + 1) * TILE_CHUNK, self.width)):
+                tile = self.tiles[row * self.width + col]
+                if not tile:
+                    continue
+                pos = ((col - cx * TILE_CHUNK) * tile_width,
+                       (row - cy * TILE_CHUNK) * tile_height)
+                if self.map.is_animated(tile):
+                    animated.append(pos + (tile,))
+                else:
+                    image = self.map.tile(tile)
+                    if image is not None:
+                        chunk.blit(image, pos)
+        if self.opacity < 255:
+            chunk.fill((255, 255, 255, self.opacity),
+                       special_flags=pygame.BLEND_RGBA_MULT)
+        self._chunks[(cx, cy)] = chunk
+        self._animated[(cx, cy)] = animated
+        return chunk
+
+class TileMap(object):
+    """
+    A TileMap is a map made in the Tiled editor (a .tmx file), drawn
+    from the tiles of its tilesets instead of from one big image.
+
+    Maps are read once and shared by every stage showing them.
+    """
+    _maps = {}      # TileMaps by path
+
+    def __init__(self, path):
+        """Read the map file at path, and the tilesets it uses."""
+        self.path = path
+        root = ElementTree.parse(path).getroot()
+        if root.get('orientation', 'orthogonal') != 'orthogonal':
+            raise ValueError('%s is not an orthogonal map' % path)
+        self.size = (int(root.get('width')), int(root.get('height')))
+        self.tile_size = (int(root.get('tilewidth')),
+                          int(root.get('tileheight')))
+        color = root.get('backgroundcolor')
+        self.background = pygame.Color('#' + color.lstrip('#')[-6:]) \
+                          if color else None
+
+        # Tilesets by the first global tile id they hold, highest first
+        self.tilesets = []
+        for node in root.findall('tileset'):
+            if node.get('source') is None:
+                raise ValueError('%s has a tileset that is not in a .tsx '
+                                 'file' % path)
+            self.tilesets.append((int(node.get('firstgid')), Tileset.load(
+                os.path.join(os.path.dirname(path), node.get('source')))))
+        self.tilesets.sort(key=lambda t: t[0], reverse=True)
+
+        self.layers = [TileLayer(self, node) for node in root.findall('layer')]
+        self._animated = sorted(set(tile for layer in self.layers
+                                    for tile in layer.tiles
+                                    if tile and self.is_animated(tile)))
+
+    @classmethod
+    def load(cls, path):
+        """Return the map read from path, reading it if needed."""
+        tile_map = cls._maps.get(path)
+        if tile_map is None:
+            tile_map = cls._maps.setdefault(path, cls(path))
+        return tile_map
+
+    def _tileset(self, tile):
+        """Return the tileset holding a global tile id, and its local id."""
+        gid = tile & ~TILE_FLAGS
+        for first, tileset in self.tilesets:
+            if gid >= first:
+                return tileset, (gid - first) | (tile & TILE_FLAGS)
+        return None, None
+
+    def tile(self, tile):
+        """Return the image of a global tile id, or None if it has none."""
+        tileset, local = self._tileset(tile)
+        return tileset.tile(local) if tileset is not None else None
+
+    def is_animated(self, tile):
+        """Return whether a global tile id is an animated tile."""
+        tileset, local = self._tileset(tile)
+        return tileset is not None \
+               and (local & ~TILE_FLAGS) in tileset.animations
+
+    def frame(self, tile, ticks):
+        """Return the image an animated tile shows at a tick of anim_clock."""
+        tileset, local = self._tileset(tile)
+        return tileset.tile(tileset.frame(local, ticks))
+
+    def animation_state(self, ticks):
+        """
+        Return something that changes whenever an animated tile of the
+        map changes at a tick of anim_clock.
+        """
+        state = []
+        for tile in self._animated:
+            tileset, local = self._tileset(tile)
+            state.append(tileset.frame(local, ticks))
+        return tuple(state)
+
+    def image_paths(self):
+        """Return the paths of the images of the map's tilesets."""
+        return [tileset.image_path for first, tileset in self.tilesets]
+
+    def prepare(self):
+        """Decode the images of the map's tilesets ahead of drawing."""
+        for first, tileset in self.tilesets:
+            tileset.image()
+
+    def draw(self, surf, scroll=(0, 0)):
+        """Draw the map onto surf, with scroll at its top left corner."""
+        if self.background is not None:
+            surf.fill(self.background)
+        for layer in self.layers:
+            if layer.visible:
+                layer.draw(surf, scroll)
+
 
 class Stage(Sprite):
     """
     A Stage holds the sprites and backgrounds in the game world.
+
+    Creating a stage only records what goes on it.  Its image and
+    background are not loaded until load() is called, and unload()
+    releases them again.
+
+    The background is either an image, scaled to fit the stage, or a
+    Tiled map, drawn at its own size with scroll at the stage's top left
+    corner.
     """
-    def __init__(self, bg_name, objects=[]):
+    def __init__(self, bg_name, objects=[], scroll=(0, 0)):
         Sprite.__init__(self)
-        self.image = Surface((224, 80))
-        self.bg = pygame.image.load(os.path.join('data', bg_name)).convert()
+        self.bg_name = bg_name
+        self.objects = objects
+        self.scroll = tuple(scroll)
         self.rect = (16, 16)
+        self.loaded = False
+
+    def load(self):
+        """Load the stage's background and set it up for drawing."""
+        if self.loaded:
+            return
+
+        self.image = Surface(STAGE_SIZE)
+        if is_tile_map(self.bg_name):
+            # Drawn by _paint_map() whenever it scrolls or animates
+            self.tile_map = TileMap.load(os.path.join('data', self.bg_name))
+            self.bg = Surface(STAGE_SIZE)
+            self._map_state = None
+        else:
+            # The background never changes, so it is scaled once and
+            # shared with every other stage using the same file.
+            self.tile_map = None
+            self.bg = assets.load_scaled(os.path.join('data', self.bg_name),
+                                         self.image.get_size(), 'convert')
 
-        # All objects on the stage
+        # All objects on the stage, and those that need updating
         self.object_space = LayeredUpdates()
-        for i, o in enumerate(objects):
+        for i, o in enumerate(self.objects):
             self.object_space.add(o, layer=i)
+        self._updated = [o for o in self.objects
+                         if not getattr(o, 'clock_driven', False)]
+
+        # Helpers for only repainting what changed
+        self._tracker = DirtyTracker()
+        self._painted = False
+        self.dirty_rects = []
+
+        self.loaded = True
+
+    def unload(self):
+        """Release the stage's image and background."""
+        if not self.loaded:
+            return
+
+        self.object_space.empty()
+        del self.image, self.bg, self.tile_map, self.object_space
+        del self._updated, self._tracker
+        self.loaded = False
+
+    def _paint_map(self):
+        """
+        Draw the stage's map onto its background if it scrolled or one of
+        its tiles animated, and return whether it did.
+        """
+        state = (self.scroll, self.tile_map.animation_state(anim_clock.ticks))
+        if state == self._map_state:
+            return False
+        self.bg.fill((0, 0, 0))
+        self.tile_map.draw(self.bg, self.scroll)
+        self._map_state = state
+        return True
 
     def update(self):
-        self.object_space.update()
-        pygame.transform.scale(self.bg, (224, 80), self.image)
-        self.object_space.draw(self.image)
+        # Animated sprites follow anim_clock, so only the rest need this.
+        for o in self._updated:
+            o.update()
+
+        if self.tile_map is not None and self._paint_map():
+            # The whole background changed.
+            self._painted = False
+
+        if not DIRTY_RECTS:
+            self.image.blit(self.bg, (0, 0))
+            self.object_space.draw(self.image)
+            return
+
+        rects = self._tracker.collect(self.object_space)
+        if not self._painted:
+            rects = [self.image.get_rect()]
+            self._painted = True
+
+        # Repaint the background and sprites under each changed area.
+        for rect in rects:
+            self.image.set_clip(rect)
+            self.image.blit(self.bg, rect, rect)
+            self.object_space.draw(self.image)
+        self.image.set_clip(None)
+        self.dirty_rects.extend(rects)
+
+class GlyphAtlas(object):
+    """
+    A GlyphAtlas packs every glyph into one surface and caches rendered
+    messages.
+
+    Each glyph has a version number that goes up whenever the glyph is
+    replaced.  Rendered messages are keyed on the versions of the glyphs
+    in them, so replacing a glyph makes old renders of it unreachable.
+    """
+    def __init__(self, glyphs, max_renders):
+        """Create a new atlas for the glyphs in the given dict."""
+        self.glyphs = glyphs
+        self.versions = dict((name, 0) for name in glyphs)
+        self.max_renders = max_renders
+        self.surface = None     # Built the first time it's needed
+        self._slots = {}        # Area of the surface used by each glyph
+        self._renders = OrderedDict()
+
+    def set_glyph(self, name, surf):
+        """Replace a glyph, invalidating renders that used the old one."""
+        self.glyphs[name] = surf
+        self.versions[name] = self.versions.get(name, 0) + 1
+        if self.surface is not None:
+            self._pack(name)
+
+    def render(self, surf, message, x, y):
+        """Draw each glyph of message onto surf, starting at (x, y)."""
+        if self.surface is None:
+            self._build()
+        for i, name in enumerate(message):
+            if self.glyphs.get(name) is not None:
+                surf.blit(self.surface, (x + GLYPH_WIDTH*i, y),
+                          self._slots[name])
+
+    def rendered(self, kind, messages, draw):
+        """
+        Return a cached image showing messages, calling draw to make it
+        if needed.  Images made by different functions need a different
+        kind.
+        """
+        key = (kind,
+               tuple(tuple(message) for message in messages),
+               tuple(self.versions.get(name, 0)
+                     for message in messages for name in message))
+        image = self._renders.pop(key, None)
+        if image is None:
+            image = draw()
+        self._renders[key] = image
+        while len(self._renders) > self.max_renders:
+            self._renders.popitem(last=False)
+        return image
+
+    def _build(self):
+        """Create the atlas surface and pack every glyph onto it."""
+        self.surface = Surface((GLYPH_WIDTH * max(len(self.glyphs), 1),
+                                GLYPH_HEIGHT))
+        self.surface.set_colorkey((255, 0, 255), pygame.RLEACCEL)
+        self.surface.fill((255, 0, 255))
+        for name in self.glyphs:
+            self._pack(name)
+
+    def _pack(self, name):
+        """Copy a glyph onto its area of the atlas surface."""
+        area = self._slots.get(name)
+        if area is None:
+            x = GLYPH_WIDTH * len(self._slots)
+            if x + GLYPH_WIDTH > self.surface.get_width():
+                # Out of room, so make the atlas twice as wide.
+                old = self.surface
+                self.surface = Surface((old.get_width() * 2, GLYPH_HEIGHT))
+                self.surface.set_colorkey((255, 0, 255), pygame.RLEACCEL)
+                self.surface.fill((255, 0, 255))
+                self.surface.blit(old, (0, 0))
+            area = pygame.Rect(x, 0, GLYPH_WIDTH, GLYPH_HEIGHT)
+            self._slots[name] = area
+
+        self.surface.fill((255, 0, 255), area)
+        if self.glyphs[name] is not None:
+            self.surface.blit(self.glyphs[name], area)
+
+glyph_atlas = GlyphAtlas(glyphs, MESSAGE_CACHE_SIZE)
 
 def render_text(surf, message, x, y):
-    for i in range(len(message)):
-        if message[i] in glyphs and glyphs[message[i]] is not None:
-            surf.blit(glyphs[message[i]], (x + GLYPH_WIDTH*i, y))
+    glyph_atlas.render(surf, message, x, y)
 
-class TextSprite(Sprite):
-    def __init__(self, message, x, y):
-        Sprite.__init__(self)
-        self.image = Surface((GLYPH_WIDTH * len(message), GLYPH_HEIGHT))
+def draw_message_box(message):
+    """Return a new image of message in a white box."""
+    image = Surface((GLYPH_WIDTH * len(message), GLYPH_HEIGHT))
 
-        # Make the message box white.
-        self.image.fill((255, 255, 255))
+    # Make the message box white.
+    image.fill((255, 255, 255))
 
-        # Draw the outline of the message box.
-        pygame.draw.rect(self.image, (0, 0, 0), (0, 0, GLYPH_WIDTH * len(message), GLYPH_HEIGHT), 1)
+    # Draw the outline of the message box.
+    pygame.draw.rect(image, (0, 0, 0), (0, 0, GLYPH_WIDTH * len(message), GLYPH_HEIGHT), 1)
 
-        # Draw each letter.
-        render_text(self.image, message, 0, 0)
+    # Draw each letter.
+    render_text(image, message, 0, 0)
+    return image
 
+class TextSprite(Sprite):
+    def __init__(self, message, x, y):
+        Sprite.__init__(self)
+        self.image = glyph_atlas.rendered('text', [message],
+                                          lambda: draw_message_box(message))
         self.rect = self.image.get_rect().move((x, y))
 
-class StoryJump(object):
-    def __init__(self, story):
-        self.story = story
-
 class StoryAnimation(object):
     def __init__(self, delay, stage):
         self.delay = delay
@@ -440,13 +1694,589 @@ class StoryMusic(object):
         self.song = song
 
     def activate(self):
-        pygame.mixer.music.load(os.path.join('music', self.song))
-        pygame.mixer.music.play(-1)
+        music_player.play(os.path.join('music', self.song))
 
 class StoryEnd(object):
     def __init__(self, msg):
         self.msg = msg
 
+# Kinds of story step, by the key that names them in a story file
+STEP_TYPES = ('music', 'frame', 'jump', 'animation', 'message', 'choice',
+              'design', 'end')
+
+# Kinds of step that only change something on the way to the next step
+STEP_EFFECTS = ('music', 'frame')
+
+class StoryError(Exception):
+    """A StoryError is raised for stories that can't be played."""
+    pass
+
+def step_type(step):
+    """Return the kind of a step from a story file."""
+    for kind in STEP_TYPES:
+        if kind in step:
+            return kind
+    raise StoryError('%r is not a kind of story step' % (step,))
+
+def effect_path(step):
+    """Return the path of the asset a music or frame change uses."""
+    if step_type(step) == 'music':
+        return os.path.join('music', step['music'])
+    return os.path.join('data', step['frame'])
+
+class StoryCompiler(object):
+    """
+    A StoryCompiler turns the contents of a story file into a flat table
+    of nodes, one for each visible step and way into it.
+
+    Jumps are followed and music and frame changes are folded into the
+    step after them, so each node lists the changes to make on entering
+    it and the table indices of the nodes that can follow: one per
+    choice for a choice step, none for an end, and otherwise the next
+    step.  An exit is None where the story runs out.  Each node also
+    lists the story positions of every node it can lead to.
+
+    Jumps, choices and sprites that lead nowhere raise StoryError.  The
+    compiled table is plain data, so that it can be cached.
+    """
+    def __init__(self, data):
+        """Create a new compiler for the parsed story file data."""
+        self.stories = data['stories']
+        self.sprites = data.get('sprites', {})
+        self.groups = data.get('groups', {})
+        self.warnings = []
+        self._assets = set()    # Paths of every asset used
+
+    def compile(self):
+        """Return the compiled table."""
+        nodes = []
+        exits = []
+        built = {}
+        entries = {}    # Node entered at each story position
+        pending = [(story, 0) for story in sorted(self.stories)]
+        while pending:
+            pos = pending.pop()
+            if pos in entries:
+                continue
+
+            effects, target = self._follow(*pos)
+            if target is None:
+                self._warn('story %r runs out without an end' % pos[0])
+                entries[pos] = None
+                continue
+
+            key = (target, tuple(id(step) for step in effects))
+            if key not in built:
+                step = self.stories[target[0]][target[1]]
+                built[key] = len(nodes)
+                nodes.append({
+                    'story': target[0],
+                    'index': target[1],
+                    'step': step,
+                    'effects': effects,
+                    'images': self._check_step(target, step)
+                })
+                for effect in effects:
+                    self._assets.add(effect_path(effect))
+                exits.append(self._exit_positions(target, step))
+                pending.extend(exits[-1])
+            entries[pos] = built[key]
+
+        for node, positions in zip(nodes, exits):
+            node['exits'] = [entries[pos] for pos in positions]
+        self._find_reachable(nodes)
+
+        return {
+            'nodes': nodes,
+            'starts': dict((story, entries[(story, 0)])
+                           for story in self.stories),
+            'sprites': self.sprites,
+            'groups': self.groups,
+            'assets': sorted(self._assets),
+            'warnings': self.warnings
+        }
+
+    def _follow(self, story, index):
+        """
+        Return the effects passed and the position of the first visible
+        step on the way from (story, index), or None for the position if
+        the story runs out first.
+        """
+        effects = []
+        seen = set()
+        while True:
+            if story not in self.stories:
+                raise StoryError('there is no story named %r' % story)
+            if index >= len(self.stories[story]):
+                return effects, None
+            if (story, index) in seen:
+                raise StoryError('story %r jumps around in a loop' % story)
+            seen.add((story, index))
+
+            step = self.stories[story][index]
+            kind = step_type(step)
+            if kind == 'jump':
+                story, index = step['jump'], 0
+            elif kind in STEP_EFFECTS:
+                effects.append(step)
+                index += 1
+            else:
+                return effects, (story, index)
+
+    def _find_reachable(self, nodes):
+        """
+        Give each node the story positions of the nodes that can follow
+        it, its own included, so that playing needs no search.
+        """
+        for node in nodes:
+            reachable = set()
+            pending = [node]
+            while pending:
+                n = pending.pop()
+                pos = (n['story'], n['index'])
+                if pos not in reachable:
+                    reachable.add(pos)
+                    pending.extend(nodes[i] for i in n['exits']
+                                   if i is not None)
+            node['reachable'] = sorted(reachable)
+
+    def _exit_positions(self, pos, step):
+        """Return the story positions that can follow the step at pos."""
+        kind = step_type(step)
+        if kind == 'choice':
+            for message, target in step['choice']:
+                if target not in self.stories:
+                    raise StoryError('a choice in story %r leads to %r, '
+                                     'which does not exist'
+                                     % (pos[0], target))
+            return [(target, 0) for message, target in step['choice']]
+        elif kind == 'end':
+            return []
+        return [(pos[0], pos[1] + 1)]
+
+    def _check_step(self, pos, step):
+        """Check a visible step and return the sprite images it uses."""
+        if step_type(step) == 'end':
+            return []
+        if 'stage' not in step:
+            raise StoryError('step %d of story %r has no stage' % (pos[1],
+                                                                  pos[0]))
+        self._assets.add(os.path.join('data', step['stage']))
+        if is_tile_map(step['stage']):
+            self._assets.update(self._map_images(step['stage']))
+        images = self._images(step.get('sprites', []), ())
+        self._assets.update(images)
+        return images
+
+    def _images(self, refs, groups):
+        """
+        Return the images of the sprites in a list of references, from
+        inside the given groups.
+        """
+        images = []
+        for ref in refs:
+            if isinstance(ref, dict):
+                name = ref['group']
+                if name not in self.groups:
+                    raise StoryError('there is no sprite group named %r'
+                                     % name)
+                if name in groups:
+                    raise StoryError('sprite group %r contains itself'
+                                     % name)
+                new = self._images(self.groups[name], groups + (name,))
+            else:
+                name = ref[0] if isinstance(ref, list) else ref
+                if name not in self.sprites:
+                    raise StoryError('there is no sprite named %r' % name)
+                sprite = self.sprites[name]
+                if 'frames' in sprite:
+                    if isinstance(ref, list) and len(ref) > 3:
+                        raise StoryError('sprite %r can not be flipped'
+                                         % name)
+                    new = [os.path.join('data', frame)
+                           for frame in sprite['frames']]
+                elif 'packed' in sprite:
+                    new = self._packed_images(sprite['packed'])
+                else:
+                    new = [os.path.join('data', sprite['sheet'])]
+            images.extend(path for path in new if path not in images)
+        return images
+
+    def _packed_images(self, info_name):
+        """Return the image of a sheet made by tools/unpiskel.py --sheet."""
+        info_path = os.path.join('data', info_name)
+        self._assets.add(info_path)
+        if not os.path.exists(info_path):
+            return []
+        with open(info_path) as f:
+            return [os.path.join('data', json.load(f)['image'])]
+
+    def _map_images(self, name):
+        """Return the tileset images of a Tiled map."""
+        path = os.path.join('data', name)
+        if not os.path.exists(path):
+            return []
+        try:
+            return TileMap.load(path).image_paths()
+        except (IOError, OSError, ValueError, ElementTree.ParseError) as e:
+            raise StoryError('map %s can not be read: %s' % (path, e))
+
+    def _warn(self, message):
+        if message not in self.warnings:
+            self.warnings.append(message)
+
+class SpriteLibrary(object):
+    """
+    A SpriteLibrary sets up the sprites named in a story file the first
+    time a stage uses them.
+
+    Each named sprite is set up once and cloned wherever a stage puts it
+    somewhere else.  Groups are lists of clones shared by every stage
+    that uses them, so their animations carry on from stage to stage.
+    """
+    def __init__(self, sprites, groups):
+        self._sprite_data = sprites
+        self._group_data = groups
+        self._sprites = {}
+        self._groups = {}
+
+    def sprite(self, name):
+        """Return the named sprite, setting it up if needed."""
+        spr = self._sprites.get(name)
+        if spr is None:
+            data = self._sprite_data[name]
+            if 'frames' in data:
+                spr = AnimatedSprite()
+                spr.setup(data.get('x', 0), data.get('y', 0), data['frames'])
+            elif 'packed' in data:
+                spr = AnimatedSheet()
+                spr.load(data.get('x', 0), data.get('y', 0), data['packed'])
+            else:
+                spr = AnimatedSheet()
+                spr.setup(data.get('x', 0), data.get('y', 0), data['sheet'],
+                          data['cols'], data['rows'], data['clip'])
+            self._sprites[name] = spr
+        return spr
+
+    def resolve(self, refs):
+        """Return the sprites a list of sprite references stands for."""
+        sprites = []
+        for ref in refs:
+            if isinstance(ref, dict):
+                group = self._groups.get(ref['group'])
+                if group is None:
+                    group = self.resolve(self._group_data[ref['group']])
+                    self._groups[ref['group']] = group
+                sprites.extend(group)
+            elif isinstance(ref, list):
+                sprites.append(self.sprite(ref[0]).clone(*ref[1:]))
+            else:
+                sprites.append(self.sprite(ref))
+        return sprites
+
+class StoryNode(object):
+    """
+    A StoryNode is a step of the story that the player sees, set up and
+    ready to play.
+
+    st is the story object shown, made from step index of story in the
+    story file, and effects are the music and frame changes made on the
+    way in.  exits are the table indices of the nodes that can follow.
+    """
+    def __init__(self, st, story, index, effects, exits):
+        self.st = st
+        self.story = story
+        self.index = index
+        self.effects = effects
+        self.exits = exits
+
+class StoryTable(object):
+    """
+    A StoryTable plays a compiled story, setting up its steps only when
+    they are first needed.
+
+    nodes is the compiled table, which is enough to find out where the
+    story can go.  node() returns a node set up for playing.  Missing
+    assets are listed in warnings, and music and frames that are missing
+    are left out.
+    """
+    def __init__(self, compiled, asset_exists=os.path.exists):
+        """Create a new table for a story compiled by StoryCompiler."""
+        self.nodes = compiled['nodes']
+        self.sprites = SpriteLibrary(compiled['sprites'], compiled['groups'])
+        self.missing = set(path for path in compiled['assets']
+                           if not asset_exists(path))
+        self.warnings = compiled['warnings'] \
+                        + ['%s is missing' % path
+                           for path in sorted(self.missing)]
+        self._starts = compiled['starts']
+        self._reachable = {}    # Positions reachable from each node so far
+        self._steps = {}    # Story objects set up so far, by position
+        self._built = {}    # Nodes set up so far, by index
+
+    def start(self, story):
+        """Return the index of the node that story starts with."""
+        if self._starts.get(story) is None:
+            raise StoryError('story %r can not be started' % story)
+        return self._starts[story]
+
+    def reachable(self, i):
+        """Return the set of story positions that node i can lead to."""
+        reachable = self._reachable.get(i)
+        if reachable is None:
+            reachable = self._reachable[i] = frozenset(
+                self.nodes[i]['reachable'])
+        return reachable
+
+    def node(self, i):
+        """Return node i, set up for playing."""
+        node = self._built.get(i)
+        if node is None:
+            data = self.nodes[i]
+            pos = (data['story'], data['index'])
+            st = self._steps.get(pos)
+            if st is None:
+                st = self._steps[pos] = self._build(data['step'])
+            effects = [self._build(step) for step in data['effects']
+                       if effect_path(step) not in self.missing]
+            node = StoryNode(st, pos[0], pos[1], effects, data['exits'])
+            self._built[i] = node
+        return node
+
+    def release(self, pos):
+        """Forget the story object set up for the step at pos."""
+        self._steps.pop(pos, None)
+        for i, node in list(self._built.items()):
+            if (node.story, node.index) == pos:
+                del self._built[i]
+
+    def _build(self, step):
+        """Return a story object for a step from a story file."""
+        kind = step_type(step)
+        if kind == 'music':
+            return StoryMusic(step['music'])
+        elif kind == 'frame':
+            return StoryFrame(step['frame'])
+        elif kind == 'end':
+            return StoryEnd(step['end'])
+
+        stage = Stage(step['stage'],
+                      self.sprites.resolve(step.get('sprites', [])),
+                      step.get('scroll', (0, 0)))
+        if kind == 'animation':
+            return StoryAnimation(step['animation'], stage)
+        elif kind == 'message':
+            return StoryMessage(step['message'], step['x'], step['y'], stage)
+        elif kind == 'choice':
+            return StoryChoice([tuple(choice) for choice in step['choice']],
+                               stage)
+        return StoryDesignGlyph(step['design'], stage)
+
+def load_stories(path, cache_path):
+    """
+    Return a StoryTable for the story file at path.
+
+    The compiled story is saved to cache_path along with the file's size
+    and modification time, and loaded from there instead of compiling the
+    file again until it changes.
+    """
+    info = os.stat(path)
+    key = (STORY_CACHE_VERSION, info.st_mtime, info.st_size)
+    try:
+        with open(cache_path, 'rb') as f:
+            cached_key, compiled = pickle.load(f)
+        if cached_key == key:
+            return StoryTable(compiled)
+    except (IOError, OSError, EOFError, ValueError, TypeError,
+            pickle.UnpicklingError):
+        pass
+
+    with open(path) as f:
+        compiled = StoryCompiler(json.load(f)).compile()
+    try:
+        with open(cache_path, 'wb') as f:
+            pickle.dump((key, compiled), f, 2)
+    except (IOError, OSError):
+        # It will just be compiled again next time.
+        pass
+    return StoryTable(compiled)
+
+def next_nodes(i):
+    """Return the indices of the story nodes that can directly follow i."""
+    return [n for n in story_table.nodes[i]['exits'] if n is not None]
+
+def upcoming_nodes(i, depth):
+    """Return the story nodes at most depth steps ahead, nearest first."""
+    upcoming = [i]
+    frontier = [i]
+    for step in range(depth):
+        frontier = [n for prev in frontier for n in next_nodes(prev)
+                    if n not in upcoming]
+        upcoming.extend(frontier)
+    return upcoming
+
+class Prefetcher(object):
+    """
+    A Prefetcher loads the assets of upcoming story nodes on a worker
+    thread, so that they are already cached by the time Game._enter
+    reaches those nodes.
+
+    At most max_pending loads wait at once.  Each time the player moves,
+    the waiting loads are replaced by those for the new position, which
+    drops work for branches that were not picked.
+    """
+    def __init__(self, depth, max_pending):
+        """Create a new prefetcher and start its worker thread."""
+        self.depth = depth
+        self.max_pending = max_pending
+        self._pending = deque()
+        self._wake = threading.Condition()
+
+        self._thread = threading.Thread(target=self._work)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def look_ahead(self, i):
+        """Queue loads for the story nodes following node i."""
+        jobs = []
+        for n in upcoming_nodes(i, self.depth):
+            for job in node_assets(story_table.nodes[n]):
+                if job not in jobs:
+                    jobs.append(job)
+
+        # Forget music decoded for branches that can't be reached.
+        music_player.keep(job[1] for job in jobs if job[0] == 'music')
+
+        with self._wake:
+            self._pending = deque(jobs[:self.max_pending])
+            self._wake.notify()
+
+    def _work(self):
+        """Run queued loads forever."""
+        while True:
+            with self._wake:
+                while not self._pending:
+                    self._wake.wait()
+                job = self._pending.popleft()
+
+            try:
+                load_asset(job)
+            except Exception:
+                # Keep the thread going for the loads after this one; the
+                # main thread will run into the error if it needs this.
+                print('could not prefetch %s:' % (job[1],), file=sys.stderr)
+                traceback.print_exc()
+
+def load_asset(job):
+    """Run a prefetcher job, loading an asset into the caches."""
+    try:
+        if job[0] == 'stage':
+            assets.load_scaled(job[1], job[2], 'convert')
+        elif job[0] == 'map':
+            TileMap.load(job[1]).prepare()
+        elif job[0] == 'image':
+            assets.load(job[1], job[2])
+        elif job[0] == 'music':
+            music_player.preload(job[1])
+    except (pygame.error, IOError, ValueError, ElementTree.ParseError):
+        # Leave it for the main thread to report when it's needed.
+        pass
+
+class StartupLoader(object):
+    """
+    A StartupLoader loads the assets the game starts with on a pool of
+    worker threads while the title screen shows.
+
+    Pygame lets go of the GIL while it decodes and converts images, so
+    the workers really do load several at once.  Jobs start in the order
+    given, so those needed first should come first.
+    """
+    def __init__(self, jobs, workers):
+        """Start running prefetcher jobs on workers threads."""
+        self._jobs = []
+        for job in jobs:
+            if job not in self._jobs:
+                self._jobs.append(job)
+        self._pending = deque(self._jobs)
+        self._done = set()
+        self._finished = threading.Condition()
+        for i in range(min(workers, len(self._jobs))):
+            thread = threading.Thread(target=self._work)
+            thread.daemon = True
+            thread.start()
+
+    def progress(self):
+        """Return how much of the loading is done, from 0 to 1."""
+        with self._finished:
+            if not self._jobs:
+                return 1.0
+            return len(self._done) / float(len(self._jobs))
+
+    def wait(self, jobs):
+        """Wait for those of jobs given to the loader to finish."""
+        jobs = [job for job in jobs if job in self._jobs]
+        with self._finished:
+            while not all(job in self._done for job in jobs):
+                self._finished.wait()
+
+    def _work(self):
+        """Run queued jobs until there are none left."""
+        while True:
+            with self._finished:
+                if not self._pending:
+                    return
+                job = self._pending.popleft()
+
+            try:
+                load_asset(job)
+            except Exception:
+                # Count the job as done so wait() does not hang on it;
+                # the main thread will run into the error when it loads
+                # the asset itself.
+                print('could not load %s:' % (job[1],), file=sys.stderr)
+                traceback.print_exc()
+            finally:
+                with self._finished:
+                    self._done.add(job)
+                    self._finished.notify_all()
+
+def startup_jobs(start):
+    """
+    Return the loads the game needs before it can enter story node start,
+    as prefetcher jobs.
+    """
+    return glyph_jobs() + node_assets(story_table.nodes[start])
+
+def start_loading(start):
+    """
+    Start loading what story node start needs, then what follows it, and
+    return the StartupLoader and the jobs to wait for before entering it.
+    """
+    needed = startup_jobs(start)
+    ahead = [job for n in upcoming_nodes(start, PREFETCH_DEPTH)
+             for job in node_assets(story_table.nodes[n])]
+    return StartupLoader(needed + ahead, STARTUP_WORKERS), needed
+
+def node_assets(node):
+    """Return the loads a compiled story node needs, as prefetcher jobs."""
+    jobs = []
+    for step in node['effects']:
+        if effect_path(step) in story_table.missing:
+            continue
+        if step_type(step) == 'music':
+            jobs.append(('music', effect_path(step)))
+        else:
+            jobs.append(('image', effect_path(step), 'convert_alpha'))
+    if 'stage' in node['step']:
+        path = os.path.join('data', node['step']['stage'])
+        if is_tile_map(path):
+            jobs.append(('map', path))
+        else:
+            jobs.append(('stage', path, STAGE_SIZE))
+    for path in node['images']:
+        jobs.append(('image', path, 'convert_alpha'))
+    return jobs
+
 class ChoiceMatrix(Sprite):
     def __init__(self, game, choices):
         Sprite.__init__(self)
@@ -458,12 +2288,9 @@ class ChoiceMatrix(Sprite):
         self._redraw_image()
 
     def _redraw_image(self):
-        mat_width = max([GLYPH_WIDTH * len(ch[0]) for ch in self.choices])
-        self.image = pygame.Surface((mat_width, GLYPH_HEIGHT * len(self.choices)))
-        self.image.fill((0, 0, 255))
-        for i, ch in enumerate(self.choices):
-            self.image.fill((200, 200, 255), pygame.Rect(0, i*GLYPH_HEIGHT, mat_width - 1, GLYPH_HEIGHT - 1))
-            render_text(self.image, ch[0], 0, i*GLYPH_HEIGHT)
+        messages = [ch[0] for ch in self.choices]
+        self.image = glyph_atlas.rendered('choices', messages,
+                                          lambda: draw_choices(messages))
         self.rect = self.image.get_rect().move((20, 120))
 
     def update(self):
@@ -471,13 +2298,25 @@ class ChoiceMatrix(Sprite):
         if self.rect.collidepoint(mouse_x, mouse_y):
             if mouse_down:
                 choice_index = int(math.floor((mouse_y - self.rect.y) / GLYPH_HEIGHT))
-                self.game._jump(self.choices[choice_index][1], 0)
+                self.game._choose(choice_index)
+
+def draw_choices(messages):
+    """Return a new image of a menu listing messages."""
+    mat_width = max([GLYPH_WIDTH * len(message) for message in messages])
+    image = pygame.Surface((mat_width, GLYPH_HEIGHT * len(messages)))
+    image.fill((0, 0, 255))
+    for i, message in enumerate(messages):
+        image.fill((200, 200, 255), pygame.Rect(0, i*GLYPH_HEIGHT, mat_width - 1, GLYPH_HEIGHT - 1))
+        render_text(image, message, 0, i*GLYPH_HEIGHT)
+    return image
 
 class Game(object):
     """
     A Game handles everything in the game.
     """
     def __init__(self):
+        load_glyphs()
+
         # In-game objects
         self.canvas        = Canvas()
         self.debug_readout = DebugReadout(self.canvas)
@@ -489,611 +2328,580 @@ class Game(object):
 
         # Collection of all objects (ensures correct drawing order)
         self.object_space = LayeredUpdates()
+        self._tracker = DirtyTracker()
+
+        # Stages currently loaded, by the story position using them
+        self.loaded_stages = {}
+
+        # Loads the assets of upcoming nodes in the background
+        self.prefetcher = Prefetcher(PREFETCH_DEPTH, PREFETCH_PENDING)
 
         # Starting mode
-        self._jump(START_STORY, 0)
+        self._enter(story_table.start(START_STORY))
+
+    def _enter(self, i):
+        """Move on to node i of the story table."""
+        node = story_table.node(i)
+        self.node_index = i
+        self.node = node
+        self.story = node.story
+        self.index = node.index
 
-    def _jump(self, story, index):
-        self.story = story
-        self.index = index
-        
         self.object_space.empty()
 
         self.canvas.clear()
-        st = stories[story][index]
-        if type(st) is StoryAnimation:
-            self.timer = st.delay
-        elif type(st) is StoryJump:
-            self._jump(st.story, 0)
-        elif type(st) is StoryDesignGlyph:
-            if st.glyph_name in emblems:
-                self.emblem.image = emblems[st.glyph_name]
-            else:
-                self.emblem.image = Surface((0, 0))
-            self.object_space.add(self.emblem, layer=3)
-            self.object_space.add(self.okay_btn, layer=3)
-            self.object_space.add(self.canvas, layer=3)
-            self.object_space.add(self.equalssign, layer=3)
-        elif type(st) is StoryMessage:
-            self.object_space.add(TextSprite(st.message, st.x, st.y), layer=3)
-        elif type(st) is StoryChoice:
-            self.object_space.add(ChoiceMatrix(self, st.choices), layer=3)
-        elif type(st) is StoryMusic:
-            st.activate()
-            self._jump(self.story, self.index + 1)
-        elif type(st) is StoryFrame:
-            self.frame.set_image(st.frame_name)
-            self._jump(self.story, self.index + 1)
-        elif type(st) is StoryEnd:
-            print(st.msg)
-            sys.exit(0)
+        for st in node.effects:
+            self.EFFECTS[type(st)](self, st)
+        enter, self._update_node = self.HANDLERS[type(node.st)]
+        enter(self, node.st)
         if DEBUG:
             self.object_space.add(self.debug_readout, layer=2)
         self.object_space.add(self.frame, layer=1)
-        self.object_space.add(stories[self.story][self.index].stage, layer=0)
+        self._load_stages()
+        self.object_space.add(node.st.stage, layer=0)
+
+    def _advance(self):
+        """Move on to the node after the current one, if there is one."""
+        if self.node.exits and self.node.exits[0] is not None:
+            self._enter(self.node.exits[0])
+
+    def _choose(self, choice_index):
+        """Move on to the node picked by a choice."""
+        if self.node.exits[choice_index] is not None:
+            self._enter(self.node.exits[choice_index])
+
+    def _load_stages(self):
+        """Load the current stage and release those out of reach."""
+        reachable = story_table.reachable(self.node_index)
+        for pos in list(self.loaded_stages):
+            if pos not in reachable:
+                self.loaded_stages.pop(pos).unload()
+                story_table.release(pos)
+
+        stage = self.node.st.stage
+        stage.load()
+        self.loaded_stages[(self.story, self.index)] = stage
+
+        self.prefetcher.look_ahead(self.node_index)
+
+    # Handlers for each kind of story node, called on entering the node
+    # and on each logic tick while it is current.
+
+    def _enter_animation(self, st):
+        self.timer = st.delay
+
+    def _update_animation(self, st):
+        self.timer -= 1
+        if self.timer <= 0:
+            self._advance()
+
+    def _enter_message(self, st):
+        self.object_space.add(TextSprite(st.message, st.x, st.y), layer=3)
+
+    def _update_message(self, st):
+        if pygame.K_SPACE in keys_just_pressed or mouse_down:
+            self._advance()
+
+    def _enter_choice(self, st):
+        self.object_space.add(ChoiceMatrix(self, st.choices), layer=3)
+
+    def _enter_design_glyph(self, st):
+        if st.glyph_name in emblems:
+            self.emblem.image = emblems[st.glyph_name]
+        else:
+            self.emblem.image = Surface((0, 0))
+        self.object_space.add(self.emblem, layer=3)
+        # The canvas goes first so that it paints the strokes of a frame
+        # before the button can accept the drawing in that same frame.
+        self.object_space.add(self.canvas, layer=3)
+        self.object_space.add(self.okay_btn, layer=3)
+        self.object_space.add(self.equalssign, layer=3)
+
+    def _enter_end(self, st):
+        print(st.msg)
+        sys.exit(0)
+
+    def _update_nothing(self, st):
+        pass
+
+    HANDLERS = {
+        StoryAnimation: (_enter_animation, _update_animation),
+        StoryMessage: (_enter_message, _update_message),
+        StoryChoice: (_enter_choice, _update_nothing),
+        StoryDesignGlyph: (_enter_design_glyph, _update_nothing),
+        StoryEnd: (_enter_end, _update_nothing)
+    }
+
+    # Handlers for the changes folded into a node, called on entering it
+
+    def _play_music(self, st):
+        st.activate()
+
+    def _change_frame(self, st):
+        self.frame.set_image(st.frame_name)
+
+    EFFECTS = {
+        StoryMusic: _play_music,
+        StoryFrame: _change_frame
+    }
 
     def update(self):
-        st = stories[self.story][self.index]
-        if type(st) is StoryMessage:
-            if pygame.K_SPACE in keys_just_pressed or mouse_down:
-                self._jump(self.story, self.index + 1)
-        elif type(st) is StoryAnimation:
-            self.timer -= 1
-            if self.timer <= 0:
-                self._jump(self.story, self.index + 1)
-        elif type(st) is StoryDesignGlyph:
-            """
-            if pygame.K_SPACE in keys_just_pressed:
-                glyphs[st.glyph_name] = self.canvas.to_surface()
-                self._jump(self.story, self.index + 1)
-            """
-            pass
+        self._update_node(self, self.node.st)
 
+        music_player.update()
+        anim_clock.tick()
         self.object_space.update()
 
     def draw(self, screen):
         self.object_space.draw(screen)
 
+    def draw_dirty(self, screen, extra_rects=()):
+        """
+        Repaint only the changed parts of screen, plus extra_rects, and
+        return them.
+        """
+        rects = merge_rects(self._tracker.collect(self.object_space)
+                            + list(extra_rects))
+        for rect in rects:
+            screen.set_clip(rect)
+            screen.fill((0, 0, 0))
+            self.object_space.draw(screen)
+        screen.set_clip(None)
+        return rects
+
+class Display(object):
+    """
+    A Display shows the virtual screen on the real one, zoomed in.
+
+    When SDL can scale the window itself (pygame.SCALED), the virtual
+    screen is the display surface and scaling costs nothing here.
+    Otherwise the virtual screen is scaled up in software by a whole
+    number, straight onto the display surface.
+
+    Asking SDL for vsync doesn't mean flips wait for the display (its
+    software renderer takes the flag and ignores it), so the display is
+    only trusted to pace frames once a few flips have been timed.
+    """
+    VSYNC_TEST_FLIPS = 4    # Flips timed to check that vsync works
+
+    def __init__(self):
+        self.zoom = 1
+        self.hardware = False   # Whether SDL does the scaling
+        self.vsync = False      # Whether flips wait for the display
+        self.screen = None
+        self.virtual_screen = None
+        self.outlined = []      # Areas outlined by DEBUG_DIRTY last frame
+        self._window = None
+
+    def open(self, zoom, fullscreen=False, hardware=True):
+        """Open (or reopen) the window, zoomed in by a whole number."""
+        size = (SCREEN_WIDTH, SCREEN_HEIGHT)
+        flags = pygame.FULLSCREEN if fullscreen else 0
+        self.zoom = max(1, int(zoom))
+        self.hardware = hardware and hasattr(pygame, 'SCALED')
+        self.vsync = False
+
+        if self.hardware:
+            try:
+                self.screen = pygame.display.set_mode(
+                    size, flags | pygame.SCALED, vsync=1)
+                self.vsync = self._flips_wait()
+            except pygame.error:
+                self.screen = pygame.display.set_mode(
+                    size, flags | pygame.SCALED)
+            if not fullscreen:
+                self._resize_window()
+            self.virtual_screen = self.screen
+        else:
+            self.screen = pygame.display.set_mode(
+                (SCREEN_WIDTH * self.zoom, SCREEN_HEIGHT * self.zoom), flags)
+            self.virtual_screen = Surface(size, 0, self.screen)
+        self.outlined = []
+
+    def _flips_wait(self):
+        """Return whether flips take about a refresh interval each."""
+        refresh_rate = 0
+        if hasattr(pygame.display, 'get_current_refresh_rate'):
+            refresh_rate = pygame.display.get_current_refresh_rate()
+        interval = 1.0 / (refresh_rate or 60)
+
+        pygame.display.flip()
+        start = timer()
+        for i in range(self.VSYNC_TEST_FLIPS):
+            pygame.display.flip()
+        # Allow for some slack, but not for flips that don't wait at all.
+        return (timer() - start) / self.VSYNC_TEST_FLIPS > interval * 0.75
+
+    def _resize_window(self):
+        """Make the window the size asked for, if SDL lets us."""
+        try:
+            from pygame._sdl2.video import Window
+        except ImportError:
+            return
+        # SDL destroys the window along with this object, so hold on to it.
+        self._window = Window.from_display_module()
+        self._window.size = (SCREEN_WIDTH * self.zoom,
+                             SCREEN_HEIGHT * self.zoom)
+
+    def to_virtual(self, pos):
+        """Return a position on the display in virtual pixels."""
+        if self.hardware:
+            return (pos[0], pos[1])
+        return (pos[0] // self.zoom, pos[1] // self.zoom)
+
+    def to_screen(self, pos):
+        """Return a position in virtual pixels as one on the display."""
+        if self.hardware:
+            return (pos[0], pos[1])
+        return (pos[0] * self.zoom, pos[1] * self.zoom)
+
+    def present(self, rects=None):
+        """
+        Show the virtual screen on the real screen.
+
+        If rects is given, only those parts of the virtual screen are
+        pushed to the display.
+        """
+        if rects is None:
+            if not self.hardware:
+                pygame.transform.scale(self.virtual_screen,
+                                       self.screen.get_size(), self.screen)
+            profiler.lap('scale')
+            pygame.display.flip()
+            profiler.lap('flip')
+            return
+
+        bounds = self.virtual_screen.get_rect()
+        rects = [rect.clip(bounds) for rect in rects]
+        if self.hardware:
+            update_rects = rects
+        else:
+            update_rects = []
+            for rect in rects:
+                zoomed = pygame.Rect(rect.x * self.zoom, rect.y * self.zoom,
+                                     rect.width * self.zoom,
+                                     rect.height * self.zoom)
+                pygame.transform.scale(self.virtual_screen.subsurface(rect),
+                                       zoomed.size,
+                                       self.screen.subsurface(zoomed))
+                update_rects.append(zoomed)
+
+        if DEBUG_DIRTY:
+            # These get repainted next frame, which erases the outlines.
+            for rect in update_rects:
+                pygame.draw.rect(self.screen, (255, 0, 255), rect, 1)
+            self.outlined = rects
+
+        profiler.lap('scale')
+        pygame.display.update(update_rects)
+        profiler.lap('flip')
+
+class InputTrace(object):
+    """
+    An InputTrace is a file of the input events of every frame, along
+    with how many logic ticks each frame ran and whether it was drawn.
+
+    The file starts with MAGIC and VERSION.  Each frame is a FRAME
+    header followed by that many EVENT records.  Mouse positions are
+    kept in virtual pixels, so a trace replays the same at any zoom.
+    Only the events the game looks at are kept.
+    """
+    MAGIC = b'MMWT'
+    VERSION = 1
+    HEADER = struct.Struct('<4sB')
+    FRAME = struct.Struct('<BBH')   # Ticks, flags, number of events
+    EVENT = struct.Struct('<Bhh')   # Kind, then x and y or a key code
+    KEY = struct.Struct('<Bi')      # Same size as EVENT, for key events
+
+    DRAWN = 1   # Frame flag for frames that were drawn
+
+    # Kinds of event, as stored in the file
+    QUIT, MOTION, BUTTON_DOWN, BUTTON_UP, KEY_DOWN = range(5)
+
+    POINTER_KINDS = {
+        pygame.MOUSEMOTION: MOTION,
+        pygame.MOUSEBUTTONDOWN: BUTTON_DOWN,
+        pygame.MOUSEBUTTONUP: BUTTON_UP
+    }
+    POINTER_TYPES = dict((kind, t) for t, kind in POINTER_KINDS.items())
+
+class TraceRecorder(InputTrace):
+    """A TraceRecorder writes frames of input to a trace file."""
+    def __init__(self, path):
+        self._file = open(path, 'wb')
+        self._file.write(self.HEADER.pack(self.MAGIC, self.VERSION))
+
+    def _encode(self, event):
+        """Return event as a record, or None if the game ignores it."""
+        if event.type == pygame.QUIT:
+            return self.EVENT.pack(self.QUIT, 0, 0)
+        elif event.type == pygame.KEYDOWN:
+            return self.KEY.pack(self.KEY_DOWN, event.key)
+        elif event.type in self.POINTER_KINDS:
+            x, y = display.to_virtual(event.pos)
+            return self.EVENT.pack(self.POINTER_KINDS[event.type],
+                                   max(-32768, min(32767, x)),
+                                   max(-32768, min(32767, y)))
+        return None
+
+    def record(self, events, ticks=0, draw=True):
+        """Add a frame with the given events to the trace."""
+        records = [r for r in map(self._encode, events) if r is not None]
+        self._file.write(self.FRAME.pack(ticks, self.DRAWN if draw else 0,
+                                         len(records)))
+        self._file.write(b''.join(records))
+
+    def close(self):
+        self._file.close()
+
+class TracePlayer(InputTrace):
+    """A TracePlayer reads back the frames of a trace file in order."""
+    def __init__(self, path):
+        with open(path, 'rb') as f:
+            self._data = f.read()
+        magic, version = self.HEADER.unpack_from(self._data, 0)
+        if magic != self.MAGIC or version != self.VERSION:
+            raise ValueError('%s is not a version %d input trace'
+                             % (path, self.VERSION))
+        self._offset = self.HEADER.size
+        self.frames = 0     # Frames read so far
+
+    def _decode(self, offset):
+        """Return the event stored at offset."""
+        kind, x, y = self.EVENT.unpack_from(self._data, offset)
+        if kind == self.QUIT:
+            return pygame.event.Event(pygame.QUIT)
+        elif kind == self.KEY_DOWN:
+            key = self.KEY.unpack_from(self._data, offset)[1]
+            return pygame.event.Event(pygame.KEYDOWN, key=key)
+        event_type = self.POINTER_TYPES[kind]
+        pos = display.to_screen((x, y))
+        if event_type == pygame.MOUSEMOTION:
+            return pygame.event.Event(event_type, pos=pos, rel=(0, 0),
+                                      buttons=(0, 0, 0))
+        return pygame.event.Event(event_type, pos=pos, button=1)
+
+    def next_frame(self):
+        """
+        Return the events, ticks and drawing flag of the next frame, or
+        None when the trace is over.
+        """
+        if self._offset >= len(self._data):
+            return None
+        ticks, flags, count = self.FRAME.unpack_from(self._data,
+                                                     self._offset)
+        self._offset += self.FRAME.size
+        events = []
+        for i in range(count):
+            events.append(self._decode(self._offset))
+            self._offset += self.EVENT.size
+        self.frames += 1
+        return events, ticks, bool(flags & self.DRAWN)
+
 # Input handling
 mouse_x = 0        # The x coordinate of the mouse (in virtual pixels)
 mouse_y = 0        # The y coordinate of the mouse (in virtual pixels)
 mouse_held = False # Whether the mouse button is being held down
 mouse_down = False # Whether the mouse buttos was just now pressed
+mouse_path = []    # Positions the mouse went through, and whether it was held
 keys_just_pressed = []
 
 # Initialize Pygame
 pygame.init()
-dimensions = (SCREEN_WIDTH * SCREEN_ZOOM,
-              SCREEN_HEIGHT * SCREEN_ZOOM)
-screen = pygame.display.set_mode(dimensions)
+display = Display()
+display.open(SCREEN_ZOOM, FULLSCREEN, HARDWARE_SCALING)
 clock = pygame.time.Clock()
+sim_clock = SimulationClock(TICKS_PER_SECOND, MAX_TICKS_PER_FRAME)
 debug_font = pygame.font.Font(None, 20)
-virtual_screen = Surface((SCREEN_WIDTH, SCREEN_HEIGHT))
-scaled_screen = Surface(dimensions, 0, virtual_screen)
 
-# Story sequence
+story_table = load_stories(STORY_FILE, STORY_CACHE)
+for warning in story_table.warnings:
+    print('warning: %s' % warning, file=sys.stderr)
 
-earth = AnimatedSprite()
-earth.setup(65, 5, ['earth0.png', 'earth1.png', 'earth2.png', 'earth3.png', 'earth4.png', 'earth5.png'])
-campfire = AnimatedSprite()
-campfire.setup(60, 41, ['fire1.png', 'fire2.png'])
-
-# arguments so you dont forget: setup(self, x, y, sheet_name, ncols, nrows, clip_region)
-cavepig = AnimatedSheet()
-cavepig.setup(0, 0, 'Main Cavemen.png', 1, 2, (97, 16, 31, 41))
-cavepig2 = AnimatedSheet()
-cavepig2.setup(0, 0, 'Main Cavemen 2.png', 1, 2, (97, 16, 31, 41))
-
-cavepig_group = [cavepig2.clone(100, 27), cavepig.clone(160, 27, False)]
-
-lizard = AnimatedSheet()
-lizard.setup(0, 0, 'Lizard Caveman.png', 1, 2, (97, 16, 31, 41))
-lizard_group = [lizard.clone(16, 27, True)]
-
-lizard_still = AnimatedSheet()
-lizard_still.setup(0, 0, 'Lizard Caveman.png', 1, 1, (97, 16, 31, 41))
-lizard_still_group = [lizard_still.clone(16, 27, True)]
-
-club = AnimatedSheet()
-club.setup(0, 0, 'Wooden Club_00_00.png', 1, 1, (0, 0, 32, 32))
-
-surrender_flag = AnimatedSheet()
-surrender_flag.setup(0, 0, 'surrenderFlag.png', 1, 1, (0, 0, 16, 16))
-bronze_pig_group = []
-cavepig2 = AnimatedSheet()
-cavepig2.setup(0, 0, 'Main Cavemen 2.png', 1, 2, (97, 16, 31, 41))
-
-big_flag = AnimatedSheet()
-big_flag.setup(0, 0, 'bigFlag.png', 1, 1, (0, 0, 32, 32))
-
-bronze_pig_1 = AnimatedSheet()
-bronze_pig_1.setup(0, 0, 'Main Bronze.png', 1, 2, (97, 16, 31, 41))
-bronze_pig_2 = AnimatedSheet()
-bronze_pig_2.setup(0, 0, 'Main Bronze 2.png', 1, 2, (97, 16, 31, 41))
-spear = AnimatedSheet()
-spear.setup(0, 0, 'Wooden Spear_00_00.png', 1, 1, (0, 0, 32, 32))
-
-bronze_pig_group = [bronze_pig_1.clone(25, 27, True), bronze_pig_2.clone(45, 27)]
-bronze_pig_alert_group = [bronze_pig_1.clone(25, 27, True), bronze_pig_2.clone(45, 27, True)]
-bronze_pig_warrior = [bronze_pig_1.clone(25, 40, True), spear.clone(35, 50)]
-
-bird = AnimatedSheet()
-bird.setup(0, 0, 'Bird Warrior 1 animation.png', 1, 2, (97, 16, 31, 41))
-bird_far = [bird.clone(170, 27)]
-bird_far_other_direction = [bird.clone(170, 27, True)]
-bird_close = [bird.clone(100, 27)]
-
-lone_pig_on_road_1 = [bronze_pig_1.clone(10, 27, True)]
-lone_pig_on_road_2 = [bronze_pig_1.clone(50, 27, True)]
-lone_pig_on_road_3 = [bronze_pig_1.clone(100, 27, True)]
-lone_pig_on_road_4 = [bronze_pig_1.clone(150, 27, True)]
-
-cat = AnimatedSheet()
-cat.setup(0, 0, 'Cat Warrior 1 animation.png', 1, 2, (72, 16, 45, 41))
-cat_guard_group = [cat.clone(65, 40, False),
-                   cat.clone(85, 40, False)]
-
-scientist = AnimatedSheet()
-scientist.setup(0, 0, 'Main Science.png', 1, 2, (97, 16, 31, 41))
-
-wizard = AnimatedSheet()
-wizard.setup(0, 0, 'Main Wizard.png', 1, 2, (97, 16, 31, 41))
-
-knight = AnimatedSheet()
-knight.setup(0, 0, 'Main Sad Knight.png', 1, 2, (97, 16, 31, 41))
-
-musician = AnimatedSheet()
-musician.setup(0, 0, 'Main Musician.png', 1, 2, (97, 16, 31, 41))
-
-renpig = AnimatedSheet()
-renpig.setup(0, 0, 'Main Renaissance.png', 1, 2, (97, 16, 31, 41))
-
-city = AnimatedSheet()
-city.setup(0, 0, 'city.png', 1, 1, (0, 0, 32, 32))
-
-politician = AnimatedSheet()
-politician.setup(0, 0, 'Main Politician.png', 1, 2, (97, 16, 31, 41))
-
-fut1 = AnimatedSheet()
-fut1.setup(0, 0, 'Main Future.png', 1, 2, (97, 16, 31, 41))
-
-fut2 = AnimatedSheet()
-fut2.setup(0, 0, 'Main Future 2.png', 1, 2, (97, 16, 31, 41))
-
-fut3 = AnimatedSheet()
-fut3.setup(0, 0, 'Main Future 3.png', 1, 2, (97, 16, 31, 41))
-
-fut4 = AnimatedSheet()
-fut4.setup(0, 0, 'Main Future Robot.png', 1, 2, (97, 16, 31, 41))
-
-bag = AnimatedSheet()
-bag.setup(0, 0, 'Bag_00_00.png', 1, 1, (0, 0, 32, 32))
-
-stories = {
-    'cave': [
-        StoryMusic('Intro.ogg'),
-        
-        # Showing the planet
-        StoryAnimation(
-            40,
-            Stage('Space.png', [earth])
-        ),
-        StoryDesignGlyph(
-            'earth',
-            Stage('Space.png', [earth])
-        ),
-        
-        # Showing the country
-        StoryAnimation(
-            40,
-            Stage('First Zoom.png', [])
-        ),
-        StoryDesignGlyph(
-            'country',
-            Stage('First Zoom.png', [])
-        ),
-
-        # Showing the village with pigs in it
-
-        StoryMusic('primitive.ogg'),
-        StoryAnimation(
-            40,
-            Stage('First Scene.png', [campfire] + cavepig_group)
-        ),
-        StoryDesignGlyph(
-            'person',
-            Stage('First Scene.png', [campfire] + cavepig_group)
-        ),
-        StoryMessage(
-            ['person', 'person', 'exclaim'],
-            64, 19,
-            Stage('First Scene.png', [campfire] + cavepig_group)
-        ),
-
-        # The lizard arrives!
-        StoryAnimation(
-            40,
-            Stage('First Scene.png', [campfire]  + cavepig_group + lizard_group)
-        ),
-
-        # Asking, "is it a person"?
-        StoryMessage(
-            ['person', 'question'],
-            94, 19,
-            Stage('First Scene.png', [campfire] + cavepig_group + lizard_group)
-        ),
-
-        # Lizard gets out the club
-        StoryMusic('primitive.ogg'),
-        StoryAnimation(
-            40,
-            Stage('First Scene.png', [campfire]  + cavepig_group + lizard_still_group + [club.clone(44, 29)])
-        ),
-        StoryDesignGlyph(
-            'club',
-            Stage('First Scene.png', [campfire] + cavepig_group + lizard_still_group + [club.clone(44, 29)])
-        ),
-
-        # "Person club!"
-        StoryMessage(
-            ['person', 'club', 'exclaim'],
-            92, 19,
-            Stage('First Scene.png', [campfire]  + cavepig_group + lizard_still_group + [club.clone(44, 29)])
-        ),
-        StoryMessage(
-            ['person', 'club', 'person', 'question', 'exclaim'],
-            92, 19,
-            Stage('First Scene.png', [campfire]  + cavepig_group + lizard_still_group + [club.clone(44, 29)])
-        ),
-
-        # Pig 1 gets out a club
-        # Pig 2 gets out a surrender flag
-        StoryMusic('BanditCombat.ogg'),
-        StoryMessage(
-            ['country', 'exclaim', 'country', 'exclaim'],
-            32, 19,
-            Stage('First Scene.png', [campfire] + cavepig_group + lizard_still_group + [club.clone(44, 29), club.clone(90, 31, True)])
-        ),
-        StoryDesignGlyph(
-            'surrender',
-            Stage('First Scene.png', [campfire] + cavepig_group + lizard_still_group + [club.clone(44, 29), club.clone(90, 31, True), surrender_flag.clone(165, 34)])
-        ),
-        StoryChoice(
-            [(['person', 'club', 'person', 'period'], 'cave_fight'),
-             (['surrender', 'period'], 'nuke')],
-            Stage('First Scene.png', [campfire] + cavepig_group + lizard_still_group + [club.clone(44, 29), club.clone(90, 31, True), surrender_flag.clone(165, 34)])
-        ),
-    ],
-    'cave_fight': [
-        StoryMessage(
-            ['person', 'club', 'person', 'exclaim'],
-            100, 19,
-            Stage('First Scene.png', [campfire] + lizard_still_group + cavepig_group + [club.clone(44, 29), club.clone(90, 31, True), surrender_flag.clone(165, 34)])
-        ),
-        StoryAnimation(
-            40,
-            Stage('First Scene.png', [campfire, lizard_still.clone(29, 27, True), club.clone(34, 27), cavepig2.clone(70, 29), club.clone(60, 29, True), cavepig.clone(160, 27)])
-        ),
-        StoryAnimation(
-            40,
-            Stage('First Scene.png', [campfire, lizard_still.clone(31, 27, True), club.clone(36, 27), cavepig2.clone(68, 29), club.clone(58, 29, True), cavepig.clone(160, 27)])
-        ),
-        StoryAnimation(
-            80,
-            Stage('First Scene.png', [campfire, lizard_still.clone(29, 27, True), club.clone(34, 27), cavepig2.clone(70, 29), club.clone(60, 29, True), cavepig.clone(160, 27)])
-        ),
-        StoryAnimation(
-            40,
-            Stage('First Scene.png', [campfire, lizard_still.clone(29, 27, True), campfire.clone(29, 27), cavepig2.clone(70, 29), club.clone(60, 29, True), cavepig.clone(160, 27)])
-        ),
-        StoryMessage(
-            ['club', 'club', 'club', 'exclaim'],
-            20, 19,
-            Stage('First Scene.png', [campfire, lizard_still.clone(29, 27, True), campfire.clone(29, 27), cavepig2.clone(70, 29, True), club.clone(40, 29, True), cavepig.clone(160, 27)])
-        ),
-
-
-        # Bronze Age
-
-        # 3000 BC
-        StoryMusic('BronzeAge.wav'),
-
-        # Pigs are alone
-        StoryAnimation(
-            40,
-            Stage('Tents.png', bronze_pig_group)
-        ),
-
-        # Birds appear
-        StoryAnimation(
-            40,
-            Stage('Tents.png', bronze_pig_group + bird_far)
-        ),
-
-        # learn "team/friendship" symbol
-        StoryDesignGlyph(
-            'team',
-            Stage('Tents.png', bronze_pig_alert_group + bird_close)
-        ),
-
-        # "person team person ?"
-        StoryMessage(
-            ['person', 'team', 'person', 'question'],
-            50, 19,
-            Stage('Tents.png', bronze_pig_alert_group + bird_close)
-        ),
-
-        # choice - team up with birds or not?
-        StoryChoice(
-            [(['person', 'team', 'person'], 'bronze_agree'),
-             (['surrender', 'period'], 'bronze_refuse')],
-            Stage('Tents.png', bronze_pig_alert_group + bird_close)
-        ),
-    ],
-
-    'bronze_agree': [
-        # bird and pig on path (roadToFair)
-        StoryMessage(
-            ['person', 'team', 'person', 'period'],
-            50, 19,
-            Stage('Tents.png', bronze_pig_group + bird_close)
-        ),
-        StoryMessage(
-            ['team', 'period'],
-            60, 19,
-            Stage('Tents.png', bronze_pig_group + bird_close)
-        ),
-
-        StoryAnimation(
-            40,
-            Stage('roadToFair.png', [bronze_pig_1.clone(40, 27, True), bird.clone(80, 27, True)])
-        ),
-        StoryAnimation(
-            40,
-            Stage('roadToFair.png', [bronze_pig_1.clone(60, 27, True), bird.clone(100, 27, True)])
-        ),
-        StoryAnimation(
-            40,
-            Stage('roadToFair.png', [bronze_pig_1.clone(80, 27, True), bird.clone(120, 27, True)])
-        ),
-        StoryAnimation(
-            40,
-            Stage('roadToFair.png', [bronze_pig_1.clone(100, 27, True), bird.clone(140, 27, True)])
-        ),
-
-        # castle of the cats - bird and pig fight the cats
-        StoryAnimation(
-            80,
-            Stage('Castle.png', bronze_pig_warrior + cat_guard_group + [bird.clone(45, 40, True)])
-        ),
-        StoryMessage(
-            ['team', 'team', 'team', 'exclaim'],
-            10, 10,
-            Stage('Castle.png', bronze_pig_warrior + cat_guard_group + [bird.clone(45, 40, True), campfire.clone(90, 27)])
-        ),
-
-        # win, pig and cat look at each other and say "team team team !"
-        StoryJump('renaissance')
-    ],
-
-    'bronze_refuse': [
-        StoryMessage(
-            ['period', 'period', 'period', 'club', 'question'],
-            50, 19,
-            Stage('Tents.png', bronze_pig_alert_group + bird_close)
-        ),
-        StoryAnimation(
-            40,
-            Stage('Tents.png', bronze_pig_alert_group + bird_close)
-        ),
-        StoryAnimation(
-            40,
-            Stage('Tents.png', bronze_pig_alert_group + bird_far_other_direction)
-        ),
-        StoryAnimation(
-            80,
-            Stage('Tents.png', bronze_pig_alert_group)
-        ),
-        # lone pig on the road
-        StoryAnimation(
-            40,
-            Stage('roadToFair.png', lone_pig_on_road_1)
-        ),
-        StoryAnimation(
-            40,
-            Stage('roadToFair.png', lone_pig_on_road_2)
-        ),
-        StoryAnimation(
-            40,
-            Stage('roadToFair.png', lone_pig_on_road_3)
-        ),
-        StoryAnimation(
-            40,
-            Stage('roadToFair.png', lone_pig_on_road_4)
-        ),
-        # castle of the cats - pig defeats cats
-        StoryAnimation(
-            40,
-            Stage('Castle.png', cat_guard_group)
-        ),
-        StoryAnimation(
-            160,
-            Stage('Castle.png', bronze_pig_warrior + cat_guard_group)
-        ),
-        StoryMessage(
-            ['club', 'club', 'club', 'exclaim'],
-            10, 10,
-            Stage('Castle.png', bronze_pig_warrior + cat_guard_group + [campfire.clone(65, 40), campfire.clone(85, 40), campfire.clone(30, 18), campfire.clone(100, 30)])
-        ),
-        # lone pig on the road
-        StoryAnimation(
-            120,
-            Stage('roadToFair.png', [bronze_pig_1.clone(50, 27)])
-        ),
-        # castle of the birds - pig defeats birds
-        StoryAnimation(80, Stage('Castle.png', [bronze_pig_1.clone(100, 40), bird.clone(50, 40, True)])),
-        StoryAnimation(80, Stage('Castle.png', [bronze_pig_1.clone(100, 40), bird.clone(50, 40, True), campfire.clone(50, 40)])),
-        # win, pig says "weapon weapon weapon !"
-        StoryMessage(
-            ['club', 'club', 'club', 'exclaim'],
-            60, 10,
-            Stage('Castle.png', [bronze_pig_1.clone(100, 40), big_flag.clone(90, 30)])),
-        StoryJump('renaissance')
-    ],
-
-    'renaissance': [
-        StoryFrame('RenaissanceFrame.png'),
-        StoryMusic('Renaissance.wav'),
-        StoryAnimation(80, Stage('roadToFair.png', [])),
-        StoryAnimation(80,
-            Stage('renaissanceFair.png', [renpig.clone(80, 37, True), scientist.clone(100, 37), wizard.clone(140, 37)])),
-        StoryDesignGlyph(
-            'tool',
-            Stage('renaissanceFair.png', [renpig.clone(80, 37, True), scientist.clone(100, 37), wizard.clone(140, 37)])),
-        StoryDesignGlyph(
-            'magic',
-            Stage('renaissanceFair.png', [renpig.clone(80, 37, True), scientist.clone(100, 37), wizard.clone(140, 37)])),
-        StoryDesignGlyph(
-            'think',
-            Stage('renaissanceFair.png', [renpig.clone(80, 37, True), scientist.clone(100, 37), wizard.clone(140, 37)])),
-        StoryAnimation(80,
-            Stage('renaissanceFair.png', [renpig.clone(80, 37, True), knight.clone(100, 37), musician.clone(140, 37)])),
-        StoryDesignGlyph(
-            'art',
-            Stage('renaissanceFair.png', [renpig.clone(80, 37, True), knight.clone(100, 37), musician.clone(140, 37)])),
-        StoryDesignGlyph(
-            'book',
-            Stage('renaissanceFair.png', [renpig.clone(80, 37, True), knight.clone(100, 37), musician.clone(140, 37)])),
-        StoryJump('future')
-    ],
-
-    'cave_surrender': [
-        StoryMessage(['person', 'surrender', 'exclaim'],
-                     165, 19,
-                     Stage('First Scene.png', [campfire] + lizard_still_group + [cavepig2.clone(100, 27, True), cavepig.clone(160, 27), club.clone(44, 29), club.clone(90, 31, True), surrender_flag.clone(165, 34)]))
-    ],
-
-    'future': [
-        StoryFrame('FutureFrame.png'),
-        StoryMusic('Future.wav'),
-        StoryAnimation(120,
-                       Stage('painting.png', [])),
-        StoryDesignGlyph('old', Stage('painting.png', [])),
-        StoryAnimation(120,
-                       Stage('Future.png', [city.clone(35, 27), fut4.clone(20, 30), politician.clone(50, 34, True), fut1.clone(100, 30), fut2.clone(110, 35), fut3.clone(140, 37)])
-        ),
-        StoryMessage(['person', 'person', 'period'],
-                     30, 10,
-                     Stage('Future.png', [city.clone(35, 27), fut4.clone(20, 30), politician.clone(50, 34, True), fut1.clone(100, 30), fut2.clone(110, 35), fut3.clone(140, 37)])
-        ),
-        StoryDesignGlyph('give',
-                         Stage('Future.png', [city.clone(35, 27), fut4.clone(20, 30), politician.clone(50, 34, True), fut1.clone(80, 30), fut2.clone(110, 35), fut3.clone(140, 37), bag.clone(60, 35)])
-        ),
-        
-        StoryMessage(['book', 'question'],
-                     30, 10,
-                     Stage('Future.png', [city.clone(35, 27), fut4.clone(20, 30), politician.clone(50, 34), fut1.clone(100, 30), fut2.clone(110, 35), fut3.clone(140, 37), bag.clone(40, 34)])
-        ),
-
-        StoryMessage(['earth', 'country', 'person', 'person', 'give', 'period', 'period', 'period'],
-                     40, 15,
-                     Stage('Future.png', [city.clone(35, 27), fut4.clone(20, 30), politician.clone(50, 34), fut1.clone(100, 30), fut2.clone(110, 35), fut3.clone(140, 37), bag.clone(40, 34)])
-        ),
-        StoryMessage(['tool', 'tool', 'period', 'club', 'club', 'period', 'magic', 'period'],
-                     45, 20,
-                     Stage('Future.png', [city.clone(35, 27), fut4.clone(20, 30), politician.clone(50, 34), fut1.clone(100, 30), fut2.clone(110, 35), fut3.clone(140, 37), bag.clone(40, 34)])
-        ),
-        StoryMessage(['earth', 'country', 'exclaim'],
-                     50, 25,
-                     Stage('Future.png', [city.clone(35, 27), fut4.clone(20, 30), politician.clone(50, 34), fut1.clone(100, 30), fut2.clone(110, 35), fut3.clone(140, 37), bag.clone(40, 34)])
-        ),
-        StoryMessage(['earth', 'country', 'person', 'old', 'book', 'art', 'period'],
-                     55, 20,
-                     Stage('Future.png', [city.clone(35, 27), fut4.clone(20, 30), politician.clone(50, 34), fut1.clone(100, 30), fut2.clone(110, 35), fut3.clone(140, 37), bag.clone(40, 34)])
-        ),
-        StoryChoice(
-            [(['team', 'period'], 'win'), (['club', 'period'], 'nuke')],
-            Stage('Future.png', [city.clone(35, 27), fut4.clone(20, 30), politician.clone(50, 34), fut1.clone(100, 30), fut2.clone(110, 35), fut3.clone(140, 37), bag.clone(40, 34)])
-        )
-    ],
-    'win': [
-        StoryMusic('Victory.wav'),
-        StoryAnimation(300, Stage('painting.png', [])),
-        StoryEnd('Ending 1')
-    ],
-    'nuke': [
-        StoryMusic('GameOver.wav'),
-        StoryAnimation(10, Stage('mushroom1.png', [])),
-        StoryAnimation(10, Stage('mushroom2.png', [])),
-        StoryAnimation(10, Stage('mushroom3.png', [])),
-        StoryAnimation(10, Stage('mushroom4.png', [])),
-        StoryAnimation(10, Stage('mushroom6.png', [])),
-        StoryAnimation(10, Stage('mushroom7.png', [])),
-        StoryAnimation(10, Stage('mushroom8.png', [])),
-        StoryAnimation(10, Stage('mushroom9.png', [])),
-        StoryAnimation(140, Stage('mushroom10.png', [])),
-        StoryEnd('Ending 2')
-    ]
-}
+title_image = assets.load(os.path.join('data', 'title.png'))
 
-title_image = pygame.image.load(os.path.join('data', 'title.png'))
+def handle_events(events):
+    """
+    Update the input state using the events from one frame.
 
-game = Game()
+    Clicks, key presses and mouse paths are kept until a logic tick has
+    seen them.
+    """
+    global mouse_x, mouse_y, mouse_held, mouse_down, keys_just_pressed
 
-closetitle = False
-while not closetitle:
-    # Handle user input (mouse and quitting).
-    for event in pygame.event.get():
-        if event.type == pygame.QUIT:
-            sys.exit()
-        elif event.type == pygame.MOUSEBUTTONDOWN:
-            closetitle = True
-
-
-    # Draw everything onto the virtual screen.
-    virtual_screen.fill((0, 0, 0))
-    virtual_screen.blit(title_image, (0, 0))
-
-    # Scale and draw onto the real screen.
-    pygame.transform.scale(virtual_screen, dimensions, scaled_screen)
-    screen.blit(scaled_screen, (0, 0))
-    pygame.display.flip()
-
-    # Wait for the next frame.
-    clock.tick(FRAMES_PER_SECOND)
-
-
-while True:
-
-    keys_just_pressed = []
-    mouse_down = False
-    # Handle user input (mouse and quitting).
-    for event in pygame.event.get():
+    for event in events:
         if event.type == pygame.QUIT:
             sys.exit()
         elif event.type == pygame.MOUSEMOTION:
-            mouse_x = event.pos[0] / SCREEN_ZOOM
-            mouse_y = event.pos[1] / SCREEN_ZOOM
+            mouse_x, mouse_y = display.to_virtual(event.pos)
+            mouse_path.append((mouse_x, mouse_y, mouse_held))
         elif event.type == pygame.MOUSEBUTTONDOWN:
+            mouse_x, mouse_y = display.to_virtual(event.pos)
             mouse_held = True
             mouse_down = True
+            mouse_path.append((mouse_x, mouse_y, mouse_held))
         elif event.type == pygame.MOUSEBUTTONUP:
+            mouse_x, mouse_y = display.to_virtual(event.pos)
             mouse_held = False
+            mouse_path.append((mouse_x, mouse_y, mouse_held))
         elif event.type == pygame.KEYDOWN:
             keys_just_pressed.append(event.key)
 
-    # If the user is painting, place a pixel.
-    game.update()
+def title_frame(events, progress=1.0):
+    """
+    Run one frame of the title screen, showing how much of the loading is
+    done, and return whether it was closed.
+    """
+    closetitle = False
+    # Handle user input (mouse and quitting).
+    for event in events:
+        if event.type == pygame.QUIT:
+            sys.exit()
+        elif event.type == pygame.MOUSEBUTTONDOWN:
+            closetitle = True
 
     # Draw everything onto the virtual screen.
-    virtual_screen.fill((0, 0, 0))
-    game.draw(virtual_screen)
+    display.virtual_screen.fill((0, 0, 0))
+    display.virtual_screen.blit(title_image, (0, 0))
+    if progress < 1:
+        # Draw a progress bar in the same ink as the title.
+        bar = pygame.Rect(48, SCREEN_HEIGHT - 20, SCREEN_WIDTH - 96, 6)
+        pygame.draw.rect(display.virtual_screen, (94, 83, 53), bar, 1)
+        display.virtual_screen.fill((94, 83, 53),
+                                    (bar.x + 2, bar.y + 2,
+                                     int((bar.width - 4) * progress),
+                                     bar.height - 4))
 
     # Scale and draw onto the real screen.
-    pygame.transform.scale(virtual_screen, dimensions, scaled_screen)
-    screen.blit(scaled_screen, (0, 0))
-    pygame.display.flip()
+    display.present()
+    return closetitle
+
+def game_frame(events, ticks=1, draw=True):
+    """Run one frame of the game, with the given number of logic ticks."""
+    global mouse_down, keys_just_pressed
 
-    # Wait for the next frame.
-    clock.tick(FRAMES_PER_SECOND)
+    # Handle user input (mouse and quitting).
+    handle_events(events)
+    profiler.lap('events')
 
+    # If the user is painting, place a pixel.
+    for tick in range(ticks):
+        game.update()
+
+        # The clicks, key presses and mouse paths have been handled now.
+        mouse_down = False
+        keys_just_pressed = []
+        del mouse_path[:]
+    profiler.lap('update')
+
+    if not draw:
+        return
+
+    # Draw everything onto the virtual screen, then scale and draw
+    # onto the real screen.
+    if DIRTY_RECTS:
+        rects = game.draw_dirty(display.virtual_screen, display.outlined)
+        profiler.lap('draw')
+        display.present(rects)
+    else:
+        display.virtual_screen.fill((0, 0, 0))
+        game.draw(display.virtual_screen)
+        profiler.lap('draw')
+        display.present()
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Play Mark My Words.')
+    parser.add_argument('--zoom', type=int, default=SCREEN_ZOOM,
+                        help='scale factor of the whole screen')
+    parser.add_argument('--fullscreen', action='store_true',
+                        default=FULLSCREEN, help='take up the whole display')
+    parser.add_argument('--software', action='store_true',
+                        default=not HARDWARE_SCALING,
+                        help='scale the screen in software instead of SDL')
+    parser.add_argument('--record', metavar='FILE',
+                        help='save the input of every frame to FILE')
+    parser.add_argument('--replay', metavar='FILE',
+                        help='play back the input saved in FILE')
+    parser.add_argument('--uncapped', action='store_true',
+                        help='run frames as fast as possible')
+    args = parser.parse_args(argv)
+
+    if (args.zoom, args.fullscreen, not args.software) \
+       != (SCREEN_ZOOM, FULLSCREEN, HARDWARE_SCALING):
+        display.open(args.zoom, args.fullscreen, not args.software)
+
+    # When flips wait for the display, they set the pace instead.
+    frame_rate = 0 if display.vsync or args.uncapped else FRAMES_PER_SECOND
+
+    recorder = TraceRecorder(args.record) if args.record else None
+    player = TracePlayer(args.replay) if args.replay else None
+    try:
+        play(recorder, player, frame_rate)
+    finally:
+        if recorder:
+            recorder.close()
+
+def play(recorder, player, frame_rate):
+    """
+    Run the game from the title screen on, recording its input with
+    recorder or taking it from player if they are given.
+    """
+    global game
+
+    def next_frame(ticks=0, draw=True):
+        """Return the events, ticks and drawing flag of the next frame."""
+        events = pygame.event.get()
+        if player:
+            # Only let the window be closed while replaying.
+            quits = [e for e in events if e.type == pygame.QUIT]
+            frame = player.next_frame()
+            if frame is None:
+                if game is None:
+                    where = 'the title screen'
+                else:
+                    where = '%s:%d' % (game.story, game.index)
+                print('Replayed %d frames in %.2f seconds, ending at %s.'
+                      % (player.frames, timer() - start, where))
+                sys.exit()
+            events, ticks, draw = frame
+            events = quits + events
+        if recorder:
+            recorder.record(events, ticks, draw)
+        return events, ticks, draw
+
+    start = timer()
+    game = None
+
+    # Load what the first node needs while the title screen shows.
+    loader, needed = start_loading(story_table.start(START_STORY))
+
+    closetitle = False
+    while not closetitle:
+        closetitle = title_frame(next_frame()[0], loader.progress())
+
+        # Wait for the next frame.
+        clock.tick(frame_rate)
+
+    loader.wait(needed)
+    game = Game()
+
+    skipped = 0
+    sim_clock.reset()
+    while True:
+        profiler.start()
+
+        # Skip drawing while the logic is behind, but not for too long.
+        # A replay runs the ticks and draws the frames that were recorded.
+        ticks = sim_clock.advance()
+        draw = not sim_clock.behind() or skipped >= MAX_FRAME_SKIP
+        skipped = 0 if draw else skipped + 1
+        events, ticks, draw = next_frame(ticks, draw)
+
+        game_frame(events, ticks, draw)
+        profiler.end_frame()
+
+        # Wait for the next frame.
+        clock.tick(frame_rate)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,312 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Headless benchmark of whole playthroughs of the game.
+
+Each route is played in its own process under SDL's dummy video and
+audio drivers.  Input is scripted: messages are skipped as soon as they
+show up, the same stroke is drawn on every glyph canvas, and each
+StoryChoice picks the branch the route asks for.  Frames run as fast as
+they can instead of at FRAMES_PER_SECOND.
+
+The report is JSON with the time it took to reach the title screen,
+frame times for each route and story node, and how long Game._enter
+took to enter each branch.
+
+With --ticks, each drawn frame runs that many logic ticks, as when the
+game catches up after a slow frame.  With --check-dirty, the game draws
+in dirty-rectangle mode, and every frame is compared with a full redraw;
+the frames that differ are counted in the report.
+"""
+
+from __future__ import print_function, division
+import sys
+import os
+import json
+import time
+import argparse
+import tempfile
+import subprocess
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Branches picked at each StoryChoice, by route name.  Between them the
+# routes go through every branch of the story.
+ROUTES = {
+    'win': ['cave_fight', 'bronze_agree', 'win'],
+    'nuke': ['cave_fight', 'bronze_refuse', 'nuke'],
+    'surrender': ['nuke']
+}
+
+# Stroke drawn on every glyph canvas, in canvas cells
+STROKE = [(2, 2), (10, 4), (17, 17), (4, 15), (4, 4)]
+
+# Give up on a route that hasn't ended after this many frames
+MAX_FRAMES = 50000
+
+timer = getattr(time, 'perf_counter', time.time)
+
+
+def percentiles(samples):
+    """Summarize a list of durations (in seconds) in milliseconds."""
+    if not samples:
+        return {'count': 0}
+    ordered = sorted(samples)
+
+    def pick(fraction):
+        i = min(len(ordered) - 1, int(round(fraction * (len(ordered) - 1))))
+        return round(ordered[i] * 1000, 3)
+
+    return {
+        'count': len(ordered),
+        'mean': round(sum(ordered) / len(ordered) * 1000, 3),
+        'p50': pick(0.50),
+        'p95': pick(0.95),
+        'p99': pick(0.99),
+        'max': round(ordered[-1] * 1000, 3)
+    }
+
+
+class ScriptedPlayer(object):
+    """
+    A ScriptedPlayer makes up the input events for each frame of a route
+    by looking at the story node the game is on.
+    """
+    def __init__(self, game_module, choices):
+        self.m = game_module
+        self.choices = choices
+        self._node = None
+        self._step = 0
+
+    def _pos(self, x, y):
+        """Return a virtual pixel position as a position on the display."""
+        return self.m.display.to_screen((int(x), int(y)))
+
+    def _motion(self, x, y, held):
+        return self.m.pygame.event.Event(self.m.pygame.MOUSEMOTION,
+                                         pos=self._pos(x, y), rel=(0, 0),
+                                         buttons=(int(held), 0, 0))
+
+    def _button(self, kind, x, y):
+        return self.m.pygame.event.Event(kind, pos=self._pos(x, y), button=1)
+
+    def _click(self, x, y):
+        pygame = self.m.pygame
+        return [self._motion(x, y, False),
+                self._button(pygame.MOUSEBUTTONDOWN, x, y),
+                self._button(pygame.MOUSEBUTTONUP, x, y)]
+
+    def _stroke_point(self, i):
+        cell = STROKE[i]
+        return (self.m.CANVAS_X + cell[0] * self.m.CANVAS_ZOOM + 1,
+                self.m.CANVAS_Y + cell[1] * self.m.CANVAS_ZOOM + 1)
+
+    def events(self):
+        """Return the scripted events for the next frame."""
+        m = self.m
+        pygame = m.pygame
+        game = m.game
+
+        node = (game.story, game.index)
+        if node != self._node:
+            self._node = node
+            self._step = 0
+        step = self._step
+        self._step += 1
+
+        st = game.node.st
+        if type(st) is m.StoryMessage:
+            if step == 0:
+                return [pygame.event.Event(pygame.KEYDOWN,
+                                           key=pygame.K_SPACE)]
+        elif type(st) is m.StoryDesignGlyph:
+            if step == 0:
+                x, y = self._stroke_point(0)
+                return [self._motion(x, y, False),
+                        self._button(pygame.MOUSEBUTTONDOWN, x, y)]
+            elif step < len(STROKE):
+                return [self._motion(*self._stroke_point(step), held=True)]
+            elif step == len(STROKE):
+                x, y = self._stroke_point(step - 1)
+                return [self._button(pygame.MOUSEBUTTONUP, x, y)]
+            elif step == len(STROKE) + 1:
+                btn = game.okay_btn.rect
+                return self._click(btn[0] + 2, btn[1] + 2)
+        elif type(st) is m.StoryChoice:
+            if step == 0:
+                targets = [ch[1] for ch in st.choices]
+                picks = [t for t in targets if t in self.choices]
+                if not picks:
+                    raise RuntimeError('route picks none of %s' % targets)
+                matrix = [spr for spr in game.object_space
+                          if isinstance(spr, m.ChoiceMatrix)][0]
+                row = targets.index(picks[0])
+                return self._click(matrix.rect.x + 2,
+                                   matrix.rect.y + row * m.GLYPH_HEIGHT + 2)
+        return []
+
+
+def screen_matches_redraw(main):
+    """Return whether the virtual screen shows what a full redraw would."""
+    screen = main.display.virtual_screen
+    redraw = main.pygame.Surface(screen.get_size(), 0, screen)
+    redraw.fill((0, 0, 0))
+    main.game.draw(redraw)
+    return main.pygame.image.tostring(screen, 'RGB') \
+           == main.pygame.image.tostring(redraw, 'RGB')
+
+
+def run_route(name, choices, result_path, ticks=1, check_dirty=False):
+    """Play one route in this process and write its results as JSON."""
+    start = timer()
+    os.environ['SDL_VIDEODRIVER'] = 'dummy'
+    os.environ['SDL_AUDIODRIVER'] = 'dummy'
+    os.environ['PYGAME_HIDE_SUPPORT_PROMPT'] = '1'
+    os.chdir(ROOT)
+    sys.path.insert(0, ROOT)
+
+    result = {'route': name, 'choices': choices, 'path': [],
+              'frames': [], 'jumps': {}, 'error': None}
+    if check_dirty:
+        result['dirty_mismatches'] = []
+
+    # Time every Game._enter, by the branch it ends up in.
+    import main
+    main.DIRTY_RECTS = check_dirty or main.DIRTY_RECTS
+    real_enter = main.Game._enter
+
+    def timed_enter(game, i):
+        enter_start = timer()
+        try:
+            real_enter(game, i)
+        finally:
+            result['jumps'].setdefault(game.story, []).append(
+                timer() - enter_start)
+    main.Game._enter = timed_enter
+
+    try:
+        # Same as main.play(), up to the title screen.
+        loader, needed = main.start_loading(
+            main.story_table.start(main.START_STORY))
+        main.title_frame(main.pygame.event.get(), loader.progress())
+        result['startup'] = timer() - start
+
+        player = ScriptedPlayer(main, choices)
+        main.title_frame(player._click(0, 0), loader.progress())
+        loader.wait(needed)
+        main.game = main.Game()
+        for frame in range(MAX_FRAMES):
+            node = '%s:%d' % (main.game.story, main.game.index)
+            if not result['path'] or result['path'][-1] != node:
+                result['path'].append(node)
+
+            frame_start = timer()
+            main.game_frame(main.pygame.event.get() + player.events(), ticks)
+            result['frames'].append((node, timer() - frame_start))
+            if check_dirty and not screen_matches_redraw(main):
+                result['dirty_mismatches'].append(node)
+        result['error'] = 'route did not end after %d frames' % MAX_FRAMES
+    except SystemExit:
+        # StoryEnd quits the game once the route is over.
+        pass
+    except Exception as e:
+        result['error'] = '%s: %s' % (type(e).__name__, e)
+
+    with open(result_path, 'w') as f:
+        json.dump(result, f)
+
+
+def summarize(results):
+    """Combine the results of every route into the final report."""
+    report = {
+        'startup_ms': percentiles([r['startup'] for r in results
+                                   if 'startup' in r]),
+        'routes': {},
+        'jump_ms': {}
+    }
+
+    jumps = {}
+    for r in results:
+        nodes = {}
+        for node, duration in r['frames']:
+            nodes.setdefault(node, []).append(duration)
+        report['routes'][r['route']] = {
+            'choices': r['choices'],
+            'error': r['error'],
+            'path': r['path'],
+            'frame_ms': percentiles([d for node, d in r['frames']]),
+            'nodes': dict((node, percentiles(durations))
+                          for node, durations in nodes.items())
+        }
+        if 'dirty_mismatches' in r:
+            report['routes'][r['route']]['dirty_mismatches'] = {
+                'count': len(r['dirty_mismatches']),
+                'nodes': sorted(set(r['dirty_mismatches']))
+            }
+        for story, durations in r['jumps'].items():
+            jumps.setdefault(story, []).extend(durations)
+
+    for story, durations in jumps.items():
+        report['jump_ms'][story] = percentiles(durations)
+    return report
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().split('\n')[0])
+    parser.add_argument('--route', action='append', default=[],
+                        metavar='NAME=BRANCH,...',
+                        help='play a route picking the given branches '
+                             '(default: %s)' % ', '.join(sorted(ROUTES)))
+    parser.add_argument('--output', '-o', metavar='FILE',
+                        help='write the report here instead of stdout')
+    parser.add_argument('--ticks', type=int, default=1,
+                        help='logic ticks to run for each drawn frame')
+    parser.add_argument('--check-dirty', action='store_true',
+                        help='draw only what changed, and count the frames '
+                             'that differ from a full redraw')
+    parser.add_argument('--run-route', nargs=3, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    if args.ticks < 1:
+        parser.error('--ticks must be at least 1')
+
+    if args.run_route:
+        name, choices, result_path = args.run_route
+        run_route(name, choices.split(','), result_path, args.ticks,
+                  args.check_dirty)
+        return
+
+    routes = dict(ROUTES)
+    if args.route:
+        routes = {}
+        for spec in args.route:
+            name, _, choices = spec.partition('=')
+            routes[name] = choices.split(',')
+
+    results = []
+    for name in sorted(routes):
+        fd, result_path = tempfile.mkstemp(suffix='.json')
+        os.close(fd)
+        try:
+            with open(os.devnull, 'w') as devnull:
+                subprocess.call([sys.executable, os.path.abspath(__file__),
+                                 '--run-route', name, ','.join(routes[name]),
+                                 result_path, '--ticks', str(args.ticks)]
+                                + (['--check-dirty'] if args.check_dirty
+                                   else []),
+                                stdout=devnull)
+            with open(result_path) as f:
+                results.append(json.load(f))
+        except ValueError:
+            print('route %s crashed' % name, file=sys.stderr)
+        finally:
+            os.remove(result_path)
+
+    report = json.dumps(summarize(results), indent=2, sort_keys=True)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(report + '\n')
+    else:
+        print(report)
+
+if __name__ == '__main__':
+    main()
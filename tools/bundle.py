@@ -0,0 +1,59 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Pack the images the game uses into one bundle file.
+
+Every image loaded at startup and every image the story uses is decoded
+and written to the bundle (data/assets.bundle by default), which the
+game memory-maps instead of opening and decoding each image.  Run this
+again after changing any image or the story.
+"""
+
+from __future__ import print_function
+import sys
+import os
+import json
+import argparse
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Extensions of the files that can be bundled
+IMAGE_TYPES = ('.png', '.jpg', '.gif', '.bmp')
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().split('\n')[0])
+    parser.add_argument('--output', '-o', metavar='FILE',
+                        help='where to write the bundle '
+                             '(default: the game\'s ASSET_BUNDLE)')
+    args = parser.parse_args()
+
+    os.environ['SDL_VIDEODRIVER'] = 'dummy'
+    os.environ['SDL_AUDIODRIVER'] = 'dummy'
+    os.environ['PYGAME_HIDE_SUPPORT_PROMPT'] = '1'
+    os.chdir(ROOT)
+    sys.path.insert(0, ROOT)
+    import main as game
+
+    # Images loaded while the game starts up, plus those in the story
+    paths = game.assets.paths()
+    paths.update(job[1] for job in game.glyph_jobs())
+    with open(game.STORY_FILE) as f:
+        compiled = game.StoryCompiler(json.load(f)).compile()
+    paths.update(path for path in compiled['assets']
+                 if path.startswith('data' + os.sep)
+                 and os.path.splitext(path)[1].lower() in IMAGE_TYPES)
+
+    writer = game.BundleWriter()
+    for path in sorted(paths):
+        if os.path.exists(path):
+            # Decode the file itself, not what an old bundle holds.
+            writer.add(path, game.pygame.image.load(path))
+        else:
+            print('skipping missing image %s' % path, file=sys.stderr)
+    output = args.output or game.ASSET_BUNDLE
+    writer.save(output)
+    print('packed %d images into %s' % (len(paths), output))
+
+if __name__ == '__main__':
+    main()
@@ -1,22 +1,44 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
+"""
+Export the frames of Piskel files as images.
+
+Each chunk of each layer of input.piskel is written next to it as
+input_LL_CC.png.  With --sheet, the layers of each frame are flattened
+instead, and the frames, trimmed of the transparent border they all
+share, are packed into input.sheet.png.  input.sheet.json describes
+the sheet for AnimatedSheet.load: where each frame is on the sheet and
+how long it shows, and which part of the full frame the trimmed frames
+cover (the clip).  Sheets need Pygame.
+
+Inputs can be .piskel files, directories of them, or glob patterns.
+Files are exported in parallel, and a manifest in each input directory
+remembers what each file held, so files that haven't changed since they
+were last exported are skipped.
+"""
 
 from __future__ import print_function
 import sys
-import os.path
+import os
+import io
 import re
+import math
 import json
+import glob
+import hashlib
+import tempfile
+import argparse
 from base64 import b64decode
+from multiprocessing import Pool
 
-if len(sys.argv) != 2:
-    print('usage: %s input.piskel' % sys.argv[0], file=sys.stderr)
-    sys.exit(1)
+# Name of the manifest kept in each directory of inputs
+MANIFEST_NAME = '.unpiskel.json'
 
 data_uri_pattern = re.compile('^data:([^;]*);base64,(.*)$')
 
 def decode_image(data_uri):
     m = data_uri_pattern.match(data_uri)
-    
+
     mimetype = m.group(1)
     data = b64decode(m.group(2))
 
@@ -28,12 +50,44 @@ def decode_image(data_uri):
 
     return (extension, data)
 
-if __name__ == '__main__':
-    input_path = sys.argv[1]
-    j = None
+def write_atomically(path, data):
+    """Write data to path so that readers never see half a file."""
+    fd, temp_path = tempfile.mkstemp(dir=os.path.dirname(path) or '.',
+                                     prefix='.unpiskel-')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(data)
+        # mkstemp makes files only their owner can read, so give the file
+        # the mode of the one it replaces, or the usual one for new files.
+        try:
+            mode = os.stat(path).st_mode & 0o777
+        except OSError:
+            umask = os.umask(0)
+            os.umask(umask)
+            mode = 0o666 & ~umask
+        os.chmod(temp_path, mode)
+        if hasattr(os, 'replace'):
+            os.replace(temp_path, path)
+        else:
+            # Python 2 can't rename over a file on Windows.
+            if os.path.exists(path) and os.name == 'nt':
+                os.remove(path)
+            os.rename(temp_path, path)
+    except BaseException:
+        os.remove(temp_path)
+        raise
+
+def file_hash(path):
+    """Return a hash of the contents of the file at path."""
+    with open(path, 'rb') as f:
+        return hashlib.sha1(f.read()).hexdigest()
+
+def export(input_path):
+    """Export the chunks of a Piskel file and return the paths written."""
     with open(input_path, 'r') as f:
         j = json.load(f)
 
+    outputs = []
     layers = j['piskel']['layers']
     for layer_num, layer_str in enumerate(layers):
         layer = json.loads(layer_str)
@@ -43,5 +97,191 @@ if __name__ == '__main__':
             output_path = os.path.join(*input_path.rsplit('.', 1)[0:-1])
             output_path += '_%02d_%02d' % (layer_num, chunk_num)
             output_path += ext
-            with open(output_path, 'wb') as f:
-                f.write(data)
+            write_atomically(output_path, data)
+            outputs.append(output_path)
+    return outputs
+
+def layer_frames(layer, width, height):
+    """Return the frames of a layer as surfaces, in order."""
+    import pygame   # Only needed for sheets
+    frames = [None] * layer['frameCount']
+    for chunk in layer['chunks']:
+        ext, data = decode_image(chunk['base64PNG'])
+        image = pygame.image.load(io.BytesIO(data), 'chunk' + ext)
+        for col, column in enumerate(chunk['layout']):
+            for row, frame in enumerate(column):
+                frames[frame] = image.subsurface(
+                    (col * width, row * height, width, height))
+    return frames
+
+def export_sheet(input_path):
+    """
+    Export a Piskel file as a trimmed spritesheet with metadata, and
+    return the paths written.
+    """
+    import pygame   # Only needed for sheets
+    with open(input_path, 'r') as f:
+        j = json.load(f)
+
+    piskel = j['piskel']
+    size = (piskel['width'], piskel['height'])
+    layers = [json.loads(layer_str) for layer_str in piskel['layers']]
+    count = max(layer['frameCount'] for layer in layers)
+
+    # Flatten the layers of each frame, bottom layer first.
+    frames = [pygame.Surface(size, pygame.SRCALPHA) for i in range(count)]
+    for layer in layers:
+        opacity = int(round(layer.get('opacity', 1) * 255))
+        for frame, image in zip(frames, layer_frames(layer, *size)):
+            if image is None:
+                continue
+            if opacity < 255:
+                image = image.copy()
+                image.fill((255, 255, 255, opacity),
+                           special_flags=pygame.BLEND_RGBA_MULT)
+            frame.blit(image, (0, 0))
+
+    # Trim the transparent border that every frame has.
+    clip = None
+    for frame in frames:
+        bounds = frame.get_bounding_rect()
+        if bounds.width and bounds.height:
+            clip = bounds if clip is None else clip.union(bounds)
+    if clip is None:
+        clip = pygame.Rect(0, 0, 1, 1)
+
+    # Pack the frames in a grid about as wide as it is tall.
+    cols = int(math.ceil(math.sqrt(count * clip.height / float(clip.width))))
+    cols = max(1, min(count, cols))
+    rows = (count + cols - 1) // cols
+    sheet = pygame.Surface((cols * clip.width, rows * clip.height),
+                           pygame.SRCALPHA)
+    sheet.fill((0, 0, 0, 0))
+    rects = []
+    for i, frame in enumerate(frames):
+        rect = pygame.Rect((i % cols) * clip.width, (i // cols) * clip.height,
+                           clip.width, clip.height)
+        sheet.blit(frame, rect, clip)
+        rects.append(list(rect))
+
+    base = os.path.join(*input_path.rsplit('.', 1)[0:-1])
+    image_path = base + '.sheet.png'
+    info_path = base + '.sheet.json'
+    duration = int(round(1000.0 / max(piskel.get('fps', 12), 1)))
+    info = {
+        'image': os.path.basename(image_path),
+        'size': list(size),
+        'clip': list(clip),
+        'frames': [{'rect': rect, 'duration': duration} for rect in rects]
+    }
+
+    data = io.BytesIO()
+    pygame.image.save(sheet, data, image_path)
+    write_atomically(image_path, data.getvalue())
+    write_atomically(info_path, (json.dumps(info, indent=2, sort_keys=True)
+                                 + '\n').encode('utf-8'))
+    return [image_path, info_path]
+
+def find_inputs(specs):
+    """Return the Piskel files named by paths, directories and globs."""
+    inputs = []
+    for spec in specs:
+        if os.path.isdir(spec):
+            paths = glob.glob(os.path.join(spec, '*.piskel'))
+        else:
+            paths = glob.glob(spec) or [spec]
+        for path in sorted(paths):
+            path = os.path.normpath(path)
+            if path not in inputs:
+                inputs.append(path)
+    return inputs
+
+def load_manifest(directory):
+    """Return the manifest of a directory of inputs."""
+    try:
+        with open(os.path.join(directory, MANIFEST_NAME)) as f:
+            return json.load(f)
+    except (IOError, OSError, ValueError):
+        return {}
+
+def save_manifest(directory, manifest):
+    data = json.dumps(manifest, indent=2, sort_keys=True) + '\n'
+    write_atomically(os.path.join(directory, MANIFEST_NAME),
+                     data.encode('utf-8'))
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description='Export the frames of Piskel files as images.')
+    parser.add_argument('inputs', nargs='+', metavar='input',
+                        help='a .piskel file, a directory of them, or a glob')
+    parser.add_argument('--sheet', action='store_true',
+                        help='pack each file into one trimmed spritesheet')
+    parser.add_argument('--force', action='store_true',
+                        help='export files even if they haven\'t changed')
+    parser.add_argument('--jobs', '-j', type=int, default=None,
+                        help='how many files to export at once '
+                             '(default: one per CPU)')
+    args = parser.parse_args(argv)
+    if args.jobs is not None and args.jobs < 1:
+        parser.error('--jobs must be at least 1')
+
+    inputs = find_inputs(args.inputs)
+    missing = [path for path in inputs if not os.path.isfile(path)]
+    if missing:
+        for path in missing:
+            print('%s: no such file' % path, file=sys.stderr)
+        return 1
+
+    # Work out which files changed since their manifest was written.
+    manifests = {}
+    hashes = {}
+    changed = []
+    for path in inputs:
+        directory, name = os.path.split(path)
+        manifest = manifests.setdefault(directory, load_manifest(directory))
+        hashes[path] = file_hash(path)
+        entry = manifest.get(name)
+        if args.force or entry is None or entry['hash'] != hashes[path] \
+           or entry.get('sheet', False) != args.sheet \
+           or not all(os.path.exists(os.path.join(directory, output))
+                      for output in entry['outputs']):
+            changed.append(path)
+
+    exporter = export_sheet if args.sheet else export
+    if len(changed) > 1 and args.jobs != 1:
+        pool = Pool(args.jobs)
+        try:
+            results = pool.map(exporter, changed)
+        finally:
+            pool.close()
+    else:
+        results = [exporter(path) for path in changed]
+
+    # Report outputs that no input writes any more.  They are left alone
+    # in case someone still wants them.
+    stale = []
+    for path, outputs in zip(changed, results):
+        directory, name = os.path.split(path)
+        written = [os.path.basename(output) for output in outputs]
+        old = manifests[directory].get(name, {}).get('outputs', [])
+        stale += [os.path.join(directory, output) for output in old
+                  if output not in written]
+        manifests[directory][name] = {'hash': hashes[path],
+                                      'sheet': args.sheet,
+                                      'outputs': written}
+    for directory, manifest in manifests.items():
+        for name in sorted(manifest):
+            if not os.path.exists(os.path.join(directory, name)):
+                stale += [os.path.join(directory, output)
+                          for output in manifest.pop(name)['outputs']]
+        save_manifest(directory, manifest)
+
+    for path in stale:
+        if os.path.exists(path):
+            print('stale: %s' % path, file=sys.stderr)
+    print('exported %d files, skipped %d unchanged'
+          % (len(changed), len(inputs) - len(changed)))
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())